@@ -1,13 +1,28 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 # vim: set ts=4 sw=4 et fdm=marker : */
+from django.core.exceptions import ImproperlyConfigured
 from django.db import models
+from ctt.managers import TreeManager
+from ctt.strategies import ClosureTableStrategy
+
+
+# closure table indexes by register(path_indexes=...): unique key and
+# covering index, columns in index order
+PATH_INDEXES = {
+    # rows mostly looked up by descendant (get_ancestors, moves)
+    'ancestors': (('ancestor', 'descendant'),
+                  ('descendant', 'path_len', 'ancestor')),
+    # rows mostly looked up by ancestor (get_descendants, get_tree)
+    'descendants': (('descendant', 'ancestor'),
+                    ('ancestor', 'path_len', 'descendant')),
+}
 
 
 class TreePathModel(models.Model):
     #    ancestor = models.ForeignKey('Node', related_name='tpa')
     #    descendant = models.ForeignKey('Node', related_name='tpd')
-    path_len = models.IntegerField(db_index=True)
+    #    path_len = models.IntegerField(db_index=True)
 
     class Meta:
         unique_together = ('ancestor', 'descendant')
@@ -20,19 +35,83 @@ class TreePathModel(models.Model):
         return '%s -> %s (%d)' % (self.ancestor, self.descendant, self.path_len)
 
 
-def register(cls):
+def register(cls, strategy=ClosureTableStrategy, path_indexes=None,
+             path_len_field=models.IntegerField):
     """
     generuje TreePathModel dla podanego modelu
     :param cls:
-    :return:
+    :param strategy: TreeStrategy subclass storing the paths,
+        AdjacencyListStrategy needs no TreePathModel
+    :param path_indexes: None keeps the original closure table indexes,
+        'ancestors' or 'descendants' (see PATH_INDEXES) replace them with
+        a unique key and a covering index for the given reads
+    :param path_len_field: field class of path_len, e.g.
+        models.PositiveSmallIntegerField for trees under 32768 levels
+    :return: TreePathModel or None
     """
-    tpcls = type(cls.__name__ + 'TreePath',
-                 (TreePathModel,),
-                 {'__module__': cls.__module__})
-    ancestor_field = models.ForeignKey(cls, related_name='tpa')
-    descendant_field = models.ForeignKey(cls, related_name='tpd')
-    ancestor_field.contribute_to_class(tpcls, 'ancestor')
-    descendant_field.contribute_to_class(tpcls, 'descendant')
+    if path_indexes is not None and path_indexes not in PATH_INDEXES:
+        raise ImproperlyConfigured(
+            'path_indexes of %s should be one of %s, got "%s".' % (
+                cls.__name__, ', '.join(sorted(PATH_INDEXES)), path_indexes))
+    strategy = strategy(cls)
+    tpcls = None
+    if strategy.uses_closure_table:
+        attrs = {'__module__': cls.__module__}
+        if path_indexes is not None:
+            # replaces single column and (ancestor, descendant, path_len)
+            # indexes
+            unique, covering = PATH_INDEXES[path_indexes]
+            attrs['Meta'] = type('Meta', (object,), {
+                'unique_together': [unique],
+                'index_together': [covering],
+            })
+        tpcls = type(cls.__name__ + 'TreePath', (TreePathModel,), attrs)
+        db_index = path_indexes is None
+        ancestor_field = models.ForeignKey(cls, related_name='tpa',
+                                           db_index=db_index)
+        descendant_field = models.ForeignKey(cls, related_name='tpd',
+                                             db_index=db_index)
+        ancestor_field.contribute_to_class(tpcls, 'ancestor')
+        descendant_field.contribute_to_class(tpcls, 'descendant')
+        path_len_field(db_index=db_index).contribute_to_class(tpcls,
+                                                              'path_len')
+    else:
+        if path_indexes is not None or \
+                path_len_field is not models.IntegerField:
+            raise ImproperlyConfigured(
+                'Closure table options of %s require the closure table '
+                'strategy.' % cls.__name__)
+        for option in ('cache_counts', 'tree_id', 'sort_key'):
+            if getattr(cls.CTTMeta, option, False):
+                raise ImproperlyConfigured(
+                    'CTTMeta.%s of %s requires the closure table strategy.' %
+                    (option, cls.__name__))
+    if getattr(cls.CTTMeta, 'cache_counts', False):
+        for name in ('child_count', 'descendant_count'):
+            field = models.PositiveIntegerField(default=0, editable=False)
+            field.contribute_to_class(cls, name)
+        cls._cache_counts = True
+    if getattr(cls.CTTMeta, 'tree_id', False):
+        # pk of the root, on nodes and on their closure rows
+        models.IntegerField(null=True, editable=False).contribute_to_class(
+            cls, 'tree_id')
+        models.IntegerField(null=True, editable=False, db_index=True). \
+            contribute_to_class(tpcls, 'tree_id')
+        cls._meta.index_together = list(cls._meta.index_together) + [
+            ('tree_id', 'level'), ('tree_id', 'parent')]
+        cls._tree_id = True
+    if getattr(cls.CTTMeta, 'sort_key', False):
+        # a segment per level, 8 characters (16 with order), so 255 fits
+        # 31 (15 orderable) levels
+        models.CharField(max_length=getattr(cls.CTTMeta, 'sort_key_length',
+                                            255),
+                         default='', editable=False,
+                         db_index=True).contribute_to_class(cls, 'sort_key')
+        cls._sort_key = True
+    if not isinstance(cls._default_manager, TreeManager):
+        # default manager was replaced, tree queries are still available
+        TreeManager().contribute_to_class(cls, 'tree')
     cls._tpm = tpcls
+    cls._strategy = strategy
     cls._cls = cls
     return tpcls
@@ -2,6 +2,8 @@
 #-*- coding: utf-8 -*-
 #vim: set ts=4 sw=4 et fdm=marker : */
 import functools
+from django.db import models
+from ctt.instrumentation import instrument
 
 
 def filtered_qs(func):
@@ -14,7 +16,32 @@ def filtered_qs(func):
     @functools.wraps(func)
     def wrapped(self, *args, **kwargs):
         ret_qs = func(self)
-        return ret_qs.filter(*args, **kwargs)
+        if args or kwargs:
+            # filter() clones, which would drop cached results
+            ret_qs = ret_qs.filter(*args, **kwargs)
+        return ret_qs
 
     return wrapped
 
+
+def instrumented(operation):
+    """
+    Measures calls of a node method, a model classmethod or a manager method
+    as operation (see ctt.instrumentation.instrument()).
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapped(self, *args, **kwargs):
+            if isinstance(self, models.Model):
+                model, node = self._cls, self
+            elif isinstance(self, type):
+                model, node = self._cls, None
+            else:
+                model, node = self.model._cls, None
+            with instrument(model, operation, node):
+                return func(self, *args, **kwargs)
+
+        return wrapped
+
+    return decorator
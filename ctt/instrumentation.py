@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+#vim: set ts=4 sw=4 et fdm=marker : */
+"""
+Measurement of tree mutations, reported with the ctt.signals.tree_operation
+signal. Nothing is measured unless the signal has receivers for the model:
+
+    from ctt.signals import tree_operation
+    from ctt.instrumentation import log_slow_operation
+
+    tree_operation.connect(log_slow_operation)
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import connections, router
+from django.db.backends import util
+from django.db.models.query import QuerySet
+from ctt.signals import tree_operation
+
+logger = logging.getLogger('ctt')
+
+_state = threading.local()
+
+
+class CountingCursor(object):
+    """
+    Passes statements executed with cursor to meter.count().
+    """
+
+    def __init__(self, cursor, meter):
+        self.cursor = cursor
+        self.meter = meter
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def execute(self, sql, params=None):
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            self.meter.count(sql, self.cursor.rowcount)
+
+    def executemany(self, sql, param_list):
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            self.meter.count(sql, self.cursor.rowcount)
+
+
+class OperationMeter(object):
+    """
+    Statistics of a single tree operation.
+    """
+
+    def __init__(self, model, operation, node, connection):
+        self.model = model
+        self.operation = operation
+        self.node = node
+        self.subtree_size = None
+        self.queries = 0
+        self.rows_written = 0
+        self.paths_deleted = 0
+        self.paths_inserted = 0
+        self.elapsed = None
+        self._paths_table = None
+        if model._tpm is not None:
+            self._paths_table = connection.ops.quote_name(
+                model._tpm._meta.db_table)
+
+    def count(self, sql, rowcount):
+        self.queries += 1
+        statement = sql.lstrip()[:6].upper()
+        if rowcount <= 0 or statement not in ('INSERT', 'UPDATE', 'DELETE'):
+            return
+        self.rows_written += rowcount
+        if self._paths_table is None:
+            return
+        words = sql.split(None, 3)
+        if len(words) < 3 or words[2] != self._paths_table:
+            return
+        if statement == 'INSERT':
+            self.paths_inserted += rowcount
+        elif statement == 'DELETE':
+            self.paths_deleted += rowcount
+
+
+def current_operation():
+    """
+    Meter of the operation being measured in this thread or None.
+    """
+    return getattr(_state, 'meter', None)
+
+
+def report_subtree_size(size):
+    """
+    Number of nodes affected by the current operation, a queryset is counted
+    after the operation is done (the query is not included in statistics).
+    """
+    meter = current_operation()
+    if meter is not None and meter.subtree_size is None:
+        meter.subtree_size = size
+
+
+@contextmanager
+def counting_cursors(connection, meter):
+    """
+    Passes statements executed on connection within the block to
+    meter.count(sql, rowcount). Blocks may be nested, statements are then
+    counted by all meters.
+    """
+    use_debug_cursor = connection.use_debug_cursor
+    patched = connection.__dict__.get('make_debug_cursor')
+    make_debug_cursor = connection.make_debug_cursor
+
+    def make_counting_cursor(cursor):
+        if use_debug_cursor or (use_debug_cursor is None and settings.DEBUG):
+            cursor = make_debug_cursor(cursor)
+        else:
+            cursor = util.CursorWrapper(cursor, connection)
+        return CountingCursor(cursor, meter)
+
+    connection.use_debug_cursor = True
+    connection.make_debug_cursor = make_counting_cursor
+    try:
+        yield meter
+    finally:
+        connection.use_debug_cursor = use_debug_cursor
+        if patched is None:
+            del connection.make_debug_cursor
+        else:
+            connection.make_debug_cursor = patched
+
+
+@contextmanager
+def instrument(model, operation, node=None):
+    """
+    Measures queries, rows written and time of the block on the database of
+    model and sends tree_operation when the block is done. Blocks nested in
+    a measured one are included in it and don't send the signal.
+    """
+    if current_operation() is not None or \
+            not tree_operation.has_listeners(model):
+        yield current_operation()
+        return
+
+    connection = connections[router.db_for_write(model)]
+    meter = OperationMeter(model, operation, node, connection)
+    _state.meter = meter
+    start = time.time()
+    try:
+        with counting_cursors(connection, meter):
+            yield meter
+    finally:
+        meter.elapsed = time.time() - start
+        _state.meter = None
+
+    if isinstance(meter.subtree_size, QuerySet):
+        meter.subtree_size = meter.subtree_size.count()
+    tree_operation.send(
+        sender=model, operation=operation, node=node,
+        pk=node.pk if node is not None else None,
+        subtree_size=meter.subtree_size, paths_deleted=meter.paths_deleted,
+        paths_inserted=meter.paths_inserted, queries=meter.queries,
+        rows_written=meter.rows_written, elapsed=meter.elapsed)
+
+
+def log_slow_operation(sender, operation, elapsed, **kwargs):
+    """
+    tree_operation receiver logging operations taking at least
+    settings.CTT_SLOW_OPERATION_SECONDS (1 by default) to the ctt logger.
+    """
+    if elapsed < getattr(settings, 'CTT_SLOW_OPERATION_SECONDS', 1.0):
+        return
+    logger.warning(
+        'Slow tree operation %s.%s on node %s: %.3fs, subtree of %s nodes, '
+        '%d queries, %d rows written, %d paths deleted, %d paths inserted',
+        sender.__name__, operation, kwargs.get('pk'), elapsed,
+        kwargs.get('subtree_size'), kwargs.get('queries', 0),
+        kwargs.get('rows_written', 0), kwargs.get('paths_deleted', 0),
+        kwargs.get('paths_inserted', 0))
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#vim: set ts=4 sw=4 et fdm=marker : */
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from ctt.management.utils import get_tree_model, tree_models
+
+
+class Command(BaseCommand):
+    args = '[app_label.ModelName ...]'
+    help = 'Rebuilds closure table (if any) and levels of given tree models ' \
+           '(all registered tree models by default).'
+    option_list = BaseCommand.option_list + (
+        make_option('--check', action='store_true', default=False,
+                    help='Only report paths and levels disagreeing with '
+                         'the parent column.'),
+        make_option('--repair', action='store_true', default=False,
+                    help='Rewrite only subtrees found broken by --check.'),
+    )
+
+    def handle(self, *labels, **options):
+        verbosity = int(options.get('verbosity', 1))
+        models = [get_tree_model(label) for label in labels] or tree_models()
+
+        for model in models:
+            name = '%s.%s' % (model._meta.app_label, model.__name__)
+            if options.get('check') or options.get('repair'):
+                self._check(model, name, options.get('repair'), verbosity)
+                continue
+            if verbosity:
+                self.stdout.write('Rebuilding %s' % name)
+
+            def progress(level, count):
+                if verbosity > 1:
+                    self.stdout.write('  level %d: %d nodes' % (level, count))
+
+            try:
+                model._rebuild_tree(progress=progress)
+            except ValueError as e:
+                raise CommandError('%s: %s' % (name, e))
+            if verbosity and model._tpm is not None:
+                self.stdout.write('  %d nodes, %d paths' % (
+                    model.objects.count(), model._tpm.objects.count()))
+            elif verbosity:
+                self.stdout.write('  %d nodes' % model.objects.count())
+
+    def _check(self, model, name, repair, verbosity):
+        report = model._check_tree()
+        problems = sorted((key, len(rows)) for key, rows in report.items()
+                          if rows)
+        if verbosity:
+            self.stdout.write('Checking %s: %s' % (name, ', '.join(
+                '%d %s' % (count, key) for key, count in problems) or 'ok'))
+        if problems and repair:
+            count = model._repair_tree(report)
+            if verbosity:
+                self.stdout.write('  %d nodes rewritten' % count)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#vim: set ts=4 sw=4 et fdm=marker : */
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, router
+from django.db.utils import OperationalError
+from ctt.management.utils import get_tree_model, tree_models
+
+
+def table_sizes(connection, table):
+    """
+    Returns (table bytes, [(index name, bytes), ...]) of table on sqlite
+    (needs the dbstat table), PostgreSQL and MySQL (all indexes together).
+    """
+    cursor = connection.cursor()
+    if connection.vendor == 'sqlite':
+        cursor.execute('SELECT name FROM sqlite_master '
+                       'WHERE type = %s AND tbl_name = %s ORDER BY name',
+                       ['index', table])
+        names = [name for name, in cursor.fetchall()]
+        try:
+            cursor.execute('SELECT name, SUM(pgsize) FROM dbstat '
+                           'WHERE name IN (%s) GROUP BY name' % ', '.join(
+                               ['%s'] * (len(names) + 1)), [table] + names)
+        except OperationalError:
+            raise CommandError('Table sizes need SQLite built with '
+                               'SQLITE_ENABLE_DBSTAT_VTAB.')
+        sizes = dict(cursor.fetchall())
+        return sizes.get(table, 0), [(name, sizes.get(name, 0))
+                                     for name in names]
+    if connection.vendor == 'postgresql':
+        cursor.execute('SELECT pg_relation_size(%s::regclass)',
+                       [connection.ops.quote_name(table)])
+        size = cursor.fetchone()[0]
+        cursor.execute('SELECT indexrelid::regclass::text, '
+                       'pg_relation_size(indexrelid) FROM pg_index '
+                       'WHERE indrelid = %s::regclass ORDER BY 1',
+                       [connection.ops.quote_name(table)])
+        return size, list(cursor.fetchall())
+    if connection.vendor == 'mysql':
+        cursor.execute('SELECT data_length, index_length '
+                       'FROM information_schema.tables '
+                       'WHERE table_schema = DATABASE() AND table_name = %s',
+                       [table])
+        size, index_size = cursor.fetchone()
+        return size, [('(all indexes)', index_size)]
+    raise CommandError('Table sizes are not available on %s.' %
+                       connection.vendor)
+
+
+class Command(BaseCommand):
+    args = '[app_label.ModelName ...]'
+    help = 'Reports rows, table and index sizes of node and closure tables ' \
+           'of given tree models (all registered tree models by default).'
+
+    def handle(self, *labels, **options):
+        models = [get_tree_model(label) for label in labels] or tree_models()
+        for model in models:
+            self.stdout.write('%s.%s' % (model._meta.app_label,
+                                         model.__name__))
+            connection = connections[router.db_for_read(model)]
+            total = 0
+            for table_model in filter(None, (model, model._tpm)):
+                table = table_model._meta.db_table
+                size, indexes = table_sizes(connection, table)
+                self.stdout.write('  %s: %d rows, %s' % (
+                    table, table_model._default_manager.count(),
+                    _format_size(size)))
+                for name, index_size in indexes:
+                    self.stdout.write('    index %s: %s' % (
+                        name, _format_size(index_size)))
+                total += size + sum(index_size for name, index_size
+                                    in indexes)
+            self.stdout.write('  total: %s' % _format_size(total))
+
+
+def _format_size(size):
+    for unit in ('B', 'KiB', 'MiB'):
+        if size < 1024:
+            return '%d %s' % (size, unit) if unit == 'B' \
+                else '%.1f %s' % (size, unit)
+        size /= 1024.0
+    return '%.1f GiB' % size
@@ -0,0 +1,21 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#vim: set ts=4 sw=4 et fdm=marker : */
+from django.conf import settings
+from django.core.management.commands import loaddata
+from ctt.management.utils import tree_models
+from ctt.models import tree_updates_deferred
+
+
+class Command(loaddata.Command):
+    """
+    loaddata which, with settings.CTT_DEFER_LOADDATA, regenerates paths and
+    levels of loaded tree nodes once all fixtures are loaded.
+    """
+
+    def handle(self, *fixture_labels, **options):
+        if not getattr(settings, 'CTT_DEFER_LOADDATA', False):
+            return super(Command, self).handle(*fixture_labels, **options)
+        with tree_updates_deferred(tree_models(),
+                                   using=options.get('database')):
+            return super(Command, self).handle(*fixture_labels, **options)
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#vim: set ts=4 sw=4 et fdm=marker : */
+"""
+Model lookups shared by ctt management commands.
+"""
+from django.core.management.base import CommandError
+from django.db.models import get_model, get_models
+from ctt.models import CTTModel
+
+
+def tree_models():
+    """
+    All models registered with ctt.register().
+    """
+    return [model for model in get_models()
+            if issubclass(model, CTTModel) and model._strategy is not None]
+
+
+def get_tree_model(label):
+    """
+    Registered tree model given as app_label.ModelName, raises CommandError
+    for anything else.
+    """
+    try:
+        app_label, model_name = label.split('.')
+    except ValueError:
+        raise CommandError('Model should be given as app_label.ModelName, '
+                           'got "%s".' % label)
+    model = get_model(app_label, model_name)
+    if model is None or not issubclass(model, CTTModel) or \
+            model._strategy is None:
+        raise CommandError('"%s" is not a registered tree model.' % label)
+    return model
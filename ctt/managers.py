@@ -1,3 +1,306 @@
 #!/usr/bin/env python
 #-*- coding: utf-8 -*-
 #vim: set ts=4 sw=4 et fdm=marker : */
+from django.db import models, connections, router, transaction
+from django.db.models import F
+from django.db.models.query import QuerySet
+from django.utils.translation import ugettext as _
+from ctt.decorators import instrumented
+from ctt.instrumentation import report_subtree_size
+from ctt.utils import chunked
+
+
+def _node_ids(nodes):
+    """
+    Nodes given as a queryset, a node, or a list of nodes or pks, in a form
+    usable in pk__in lookups. Querysets become subqueries.
+    """
+    if isinstance(nodes, QuerySet):
+        return nodes.values('pk')
+    if isinstance(nodes, models.Model):
+        return [nodes.pk]
+    return [getattr(node, 'pk', node) for node in nodes]
+
+
+class TreeQuerySet(QuerySet):
+    def descendants_of(self, nodes, include_self=False):
+        """
+        Descendants of any of nodes, as one subquery (on the closure table
+        or a recursive one, depending on the model's strategy).
+        """
+        return self.model._strategy.filter_descendants(
+            self.all(), _node_ids(nodes), include_self)
+
+    def ancestors_of(self, nodes, include_self=False):
+        """
+        Ancestors of any of nodes, as one subquery.
+        """
+        return self.model._strategy.filter_ancestors(
+            self.all(), _node_ids(nodes), include_self)
+
+    def children_of(self, nodes):
+        return self.filter(parent_id__in=_node_ids(nodes))
+
+    def descendants_by_parent(self, parents, min_depth=1, max_depth=None):
+        """
+        Descendants of each of parents (nodes or pks), min_depth to max_depth
+        levels below it, with one query (per 500 parents). Returns
+        {parent pk: [nodes]}, nodes level by level in sibling order
+        (preorder with CTTMeta.sort_key).
+        """
+        pks = [getattr(parent, 'pk', parent) for parent in parents]
+        grouped = dict((pk, []) for pk in pks)
+        for chunk in chunked(set(pks)):
+            for parent_id, node in self.model._strategy.descendants_by_root(
+                    self.all(), chunk, min_depth, max_depth):
+                grouped[parent_id].append(node)
+        return grouped
+
+    def roots(self):
+        return self.filter(parent__isnull=True)
+
+    def leaves(self):
+        if self.model._cache_counts:
+            return self.filter(child_count=0)
+        return self.model._strategy.leaves(self.all())
+
+    def at_depth(self, level):
+        return self.filter(level=level)
+
+    def delete_subtrees(self, send_signals=False):
+        """
+        Deletes nodes of the queryset with all their descendants. Unlike
+        delete(), nodes are not loaded nor collected one by one: closure rows
+        and nodes go away in a constant number of queries. With send_signals
+        pre_delete and post_delete are sent for every node, nodes are then
+        loaded in chunks. Returns number of deleted nodes.
+        """
+        return self.model._delete_subtrees(self.values('pk'), self.db,
+                                           send_signals)
+
+    def with_ancestors(self):
+        """
+        Loads ancestors of all nodes with one extra query, get_ancestors()
+        of the nodes then doesn't hit the database.
+        """
+        return self.prefetch_related('ancestors')
+
+    def in_tree(self, tree):
+        """
+        Nodes of one tree, given by any of its nodes or by tree_id (requires
+        CTTMeta.tree_id).
+        """
+        return self.filter(tree_id=getattr(tree, 'tree_id', tree))
+
+    def _with_closure_subquery(self, name, sql):
+        sql = self.model._strategy.format_sql(sql, connections[self.db])
+        return self.extra(select={name: sql})
+
+    def with_descendant_count(self):
+        """
+        Annotates nodes with descendant_count, used by get_descendant_count().
+        """
+        if self.model._cache_counts:
+            return self.all()
+        return self._with_closure_subquery(
+            'descendant_count', self.model._strategy.descendant_count_sql)
+
+    def with_child_count(self):
+        """
+        Annotates nodes with child_count.
+        """
+        if self.model._cache_counts:
+            return self.all()
+        return self._with_closure_subquery(
+            'child_count', self.model._strategy.child_count_sql)
+
+    def with_is_leaf(self):
+        """
+        Annotates nodes with is_leaf (1 or 0), used by is_leaf_node().
+        """
+        if self.model._cache_counts:
+            return self._with_closure_subquery(
+                'is_leaf',
+                'CASE WHEN {node}.{child_count} = 0 THEN 1 ELSE 0 END')
+        return self._with_closure_subquery(
+            'is_leaf', self.model._strategy.is_leaf_sql)
+
+
+class TreeManager(models.Manager):
+    def get_queryset(self):
+        return TreeQuerySet(self.model, using=self._db)
+
+    def with_ancestors(self):
+        return self.get_queryset().with_ancestors()
+
+    def descendants_of(self, nodes, include_self=False):
+        return self.get_queryset().descendants_of(nodes, include_self)
+
+    def ancestors_of(self, nodes, include_self=False):
+        return self.get_queryset().ancestors_of(nodes, include_self)
+
+    def children_of(self, nodes):
+        return self.get_queryset().children_of(nodes)
+
+    def descendants_by_parent(self, parents, min_depth=1, max_depth=None):
+        return self.get_queryset().descendants_by_parent(parents, min_depth,
+                                                         max_depth)
+
+    def roots(self):
+        return self.get_queryset().roots()
+
+    def leaves(self):
+        return self.get_queryset().leaves()
+
+    def at_depth(self, level):
+        return self.get_queryset().at_depth(level)
+
+    def in_tree(self, tree):
+        return self.get_queryset().in_tree(tree)
+
+    def with_descendant_count(self):
+        return self.get_queryset().with_descendant_count()
+
+    def with_child_count(self):
+        return self.get_queryset().with_child_count()
+
+    def with_is_leaf(self):
+        return self.get_queryset().with_is_leaf()
+
+    @instrumented('bulk_create_tree')
+    def bulk_create_tree(self, nodes, batch_size=None):
+        """
+        Inserts unsaved nodes whose parents are other nodes from the same
+        batch or already saved rows. Levels are computed in memory, nodes are
+        inserted with bulk_create and closure rows (if any) are written with
+        one INSERT ... SELECT per tree level.
+
+        Like bulk_create, this doesn't call save() nor send signals. Nodes
+        without pk that are parents of other nodes from the batch are
+        inserted one by one, as bulk_create can't return their keys.
+        """
+        model = self.model
+        nodes = list(nodes)
+        if not nodes:
+            return nodes
+        report_subtree_size(len(nodes))
+
+        cache_name = model._meta.get_field('parent').get_cache_name()
+        in_batch = set(id(node) for node in nodes)
+        batch_parents = {}
+        for node in nodes:
+            parent = getattr(node, cache_name, None)
+            if parent is not None and id(parent) in in_batch:
+                batch_parents[id(node)] = parent
+            elif parent is not None and parent.pk is None:
+                raise ValueError(
+                    _('Parent of a node is neither saved nor in the batch.'))
+
+        existing_levels = {}
+        existing_tree_ids = {}
+        existing_ids = set(node.parent_id for node in nodes
+                           if id(node) not in batch_parents and
+                           node.parent_id is not None)
+        for ids in chunked(existing_ids):
+            if model._tree_id:
+                for pk, level, tree_id in self.filter(pk__in=ids). \
+                        values_list('pk', 'level', 'tree_id'):
+                    existing_levels[pk] = level
+                    existing_tree_ids[pk] = tree_id
+            else:
+                existing_levels.update(
+                    self.filter(pk__in=ids).values_list('pk', 'level'))
+        if len(existing_levels) != len(existing_ids):
+            raise ValueError(_('Parent of a node does not exist.'))
+
+        levels = {}
+        for node in nodes:
+            chain = []
+            current = node
+            while id(current) not in levels:
+                parent = batch_parents.get(id(current))
+                if parent is None:
+                    levels[id(current)] = 0 if current.parent_id is None \
+                        else existing_levels[current.parent_id] + 1
+                    break
+                chain.append(current)
+                if len(chain) > len(nodes):
+                    raise ValueError(_('Nodes in the batch form a cycle.'))
+                current = parent
+            for child in reversed(chain):
+                levels[id(child)] = levels[id(batch_parents[id(child)])] + 1
+
+        by_level = {}
+        for node in nodes:
+            node.level = levels[id(node)]
+            by_level.setdefault(node.level, []).append(node)
+        has_children = set(id(parent) for parent in batch_parents.values())
+        model._prepare_bulk_nodes(nodes, batch_parents)
+        if model._cache_counts:
+            added = self._count_bulk_nodes(by_level, batch_parents)
+
+        with transaction.atomic(using=router.db_for_write(model)):
+            for level in sorted(by_level):
+                bulk = []
+                for node in by_level[level]:
+                    parent = batch_parents.get(id(node))
+                    if parent is not None:
+                        node.parent_id = parent.pk
+                    if model._tree_id:
+                        node.tree_id = parent.tree_id if parent is not None \
+                            else existing_tree_ids.get(node.parent_id, node.pk)
+                    if node.pk is None and id(node) in has_children:
+                        # plain Model.save, closure rows are written below
+                        models.Model.save(node, force_insert=True)
+                        if model._tree_id and node.parent_id is None:
+                            node.tree_id = node.pk
+                    else:
+                        bulk.append(node)
+                self.bulk_create(bulk, batch_size=batch_size)
+                if model._tree_id and level == 0:
+                    # roots inserted without pk
+                    self.filter(parent__isnull=True, tree_id__isnull=True). \
+                        update(tree_id=F(model._meta.pk.attname))
+                model._strategy.insert_new_paths(level)
+            if model._cache_counts:
+                tp_objects = model._tpm.objects
+                for parent_id, (children, size) in added.items():
+                    self.filter(pk=parent_id).update(
+                        child_count=F('child_count') + children)
+                    ancestors = tp_objects.filter(descendant_id=parent_id). \
+                        values('ancestor_id')
+                    self.filter(pk__in=ancestors).update(
+                        descendant_count=F('descendant_count') + size)
+            if model._sort_key:
+                model._fill_sort_keys(self.filter(sort_key=''))
+                saved = [node for node in nodes if node.pk is not None]
+                for chunk in chunked(saved):
+                    sort_keys = dict(self.filter(
+                        pk__in=[node.pk for node in chunk]).
+                        values_list('pk', 'sort_key'))
+                    for node in chunk:
+                        node.sort_key = sort_keys[node.pk]
+        for node in nodes:
+            node._mark_loaded()
+        return nodes
+
+    def _count_bulk_nodes(self, by_level, batch_parents):
+        """
+        Sets child_count and descendant_count of new nodes, returns counts to
+        add to saved parents: {parent_id: (children, nodes)}.
+        """
+        for level_nodes in by_level.values():
+            for node in level_nodes:
+                node.child_count = node.descendant_count = 0
+        added = {}
+        for level in sorted(by_level, reverse=True):
+            for node in by_level[level]:
+                parent = batch_parents.get(id(node))
+                if parent is not None:
+                    parent.child_count += 1
+                    parent.descendant_count += node.descendant_count + 1
+                elif node.parent_id is not None:
+                    children, size = added.get(node.parent_id, (0, 0))
+                    added[node.parent_id] = (
+                        children + 1, size + node.descendant_count + 1)
+        return added
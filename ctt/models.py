@@ -5,20 +5,127 @@
 """
 Closure Tables Tree models.
 """
-from django.db import models
-from django.db.models import F
+import operator
+import threading
+from contextlib import contextmanager
+from django.db import models, connections, router, transaction
+from django.db.models import F, Max, signals
+from django.db.models.deletion import Collector
 from django.db.models.query_utils import Q
-from ctt.decorators import filtered_qs
+from ctt.decorators import filtered_qs, instrumented
+from ctt.instrumentation import report_subtree_size
+from ctt.managers import TreeManager
+from ctt.utils import chunked, cached_qs, cache_tree_children
 from django.utils.translation import ugettext as _
 
+_UNKNOWN = object()
+
+_deferred = threading.local()
+
+
+class DeferredTreeUpdates(object):
+    """
+    Nodes inserted or moved while tree updates of their model are deferred.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.pks = set()
+        self.old_parent_ids = set()
+
+    def add(self, pk, old_parent_id=None):
+        self.pks.add(pk)
+        if old_parent_id is not None:
+            self.old_parent_ids.add(old_parent_id)
+
+    def apply(self):
+        """
+        Regenerates subtrees of recorded nodes, counts of their former
+        ancestors are recounted too.
+        """
+        if self.pks:
+            self.model._repair_subtrees(self.pks)
+        if self.model._cache_counts and self.old_parent_ids:
+            self.model._rebuild_counts(pks=self.old_parent_ids)
+
+
+def _deferred_updates(model):
+    return getattr(_deferred, 'models', {}).get(model)
+
+
+@contextmanager
+def tree_updates_deferred(models, using=None):
+    """
+    Within the block, save(), insert_at() and move_to() of nodes of models
+    only write the node row and record its pk, raw saves (loaddata) are
+    recorded as well. On exit paths, level (and the other tree columns) of
+    the recorded subtrees are regenerated set-based, in the same
+    transaction. Tree queries within the block see the old paths.
+    """
+    if not hasattr(_deferred, 'models'):
+        _deferred.models = {}
+    started = [DeferredTreeUpdates(model._cls) for model in models
+               if model._cls not in _deferred.models]
+    for deferred in started:
+        _deferred.models[deferred.model] = deferred
+    try:
+        with transaction.atomic(
+                using=using or router.db_for_write(models[0]._cls)):
+            yield
+            for deferred in started:
+                del _deferred.models[deferred.model]
+                deferred.apply()
+    finally:
+        for deferred in started:
+            _deferred.models.pop(deferred.model, None)
+
+
+def _record_raw_save(sender, instance, raw, **kwargs):
+    deferred = raw and _deferred_updates(getattr(sender, '_cls', None))
+    if deferred:
+        deferred.add(instance.pk)
+
+
+signals.post_save.connect(_record_raw_save)
+
+
+class AncestorsDescriptor(object):
+    """
+    node.ancestors is node.get_ancestors(), prefetchable with
+    prefetch_related('ancestors') - all ancestors of all nodes are then
+    fetched with a single query.
+    """
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return instance.get_ancestors()
+
+    def is_cached(self, instance):
+        return 'ancestors' in getattr(instance, '_prefetched_objects_cache',
+                                      {})
+
+    def get_prefetch_queryset(self, instances):
+        ancestors = instances[0]._strategy.prefetch_ancestors(instances)
+        return (ancestors, operator.attrgetter('_ancestor_of'),
+                operator.attrgetter('pk'), False, 'ancestors')
+
 
 class CTTModel(models.Model):
     parent = models.ForeignKey('self', null=True, blank=True)
     level = models.IntegerField(default=0, blank=True, db_index=True)
     _tpm = None  # overwrite by core.register()
+    _strategy = None  # overwrite by core.register()
     tpd = None  # overwrite by core.register()
     tpa = None  # overwrite by core.register()
     _cls = None
+    _cache_counts = False  # overwrite by core.register()
+    _tree_id = False  # overwrite by core.register()
+    _sort_key = False  # overwrite by core.register()
+    _sort_key_fields = ('pk',)
+
+    objects = TreeManager()
+    ancestors = AncestorsDescriptor()
 
     class Meta:
         abstract = True
@@ -28,104 +135,494 @@ class CTTModel(models.Model):
 
     class CTTMeta:
         parent_field = 'parent'
+        # adds child_count and descendant_count columns kept up to date
+        # on insert, move and delete
+        cache_counts = False
+        # adds tree_id column (pk of the root) to nodes and closure rows,
+        # per-tree queries and rebuilds can then use it
+        tree_id = False
+        # adds sort_key column (materialized path of fixed width segments
+        # per level), get_descendants(ordered=True) then returns preorder;
+        # 255 characters are enough for 31 levels (15 in CTTOrderableModel)
+        sort_key = False
 
     def __unicode__(self):
         if hasattr(self, 'name'):
             return self.name
         return unicode(self.pk)
 
+    def __init__(self, *args, **kwargs):
+        super(CTTModel, self).__init__(*args, **kwargs)
+        self._mark_loaded()
+
+    def _mark_loaded(self):
+        """
+        Remembers parent_id and level as stored in database, so save() can
+        tell whether the node was moved without querying for it. Deferred
+        fields are marked as unknown.
+        """
+        self._loaded_parent_id = self.__dict__.get('parent_id', _UNKNOWN)
+        self._loaded_level = self.__dict__.get('level', _UNKNOWN)
+
+    def _set_tree_fields(self):
+        """
+        Sets level (and tree_id) from parent, new roots get their tree_id
+        in _insert(). Returns sort_key of the parent ('' for roots), new
+        nodes get their key in _insert() too.
+        """
+        if self.parent_id is None:
+            self.level = 0
+            if self._tree_id:
+                self.tree_id = self.pk
+            return ''
+        names = ['level']
+        if self._tree_id:
+            names.append('tree_id')
+        if self._sort_key:
+            names.append('sort_key')
+        parent = getattr(self, self._meta.get_field('parent').get_cache_name(),
+                         None)
+        if parent is not None and parent._loaded_level is not _UNKNOWN and \
+                all(name in parent.__dict__ for name in names):
+            values = [getattr(parent, name) for name in names]
+        else:
+            values = self._cls.objects.filter(pk=self.parent_id). \
+                values_list(*names).get()
+        values = dict(zip(names, values))
+        self.level = values['level'] + 1
+        if self._tree_id:
+            self.tree_id = values['tree_id']
+        return values.get('sort_key', '')
+
+    @instrumented('save')
     def save(self, force_insert=False, force_update=False, using=None,
              **kwargs):
         is_new = force_insert or self.pk is None
-        if not is_new:
-            old_parent = self._cls.objects.get(pk=self.pk).parent
-        else:
-            old_parent = None
-        if self.parent:
-            self.level = self.parent.level + 1
-        else:
-            self.level = 0
-        super(CTTModel, self).save(force_insert, force_update, using, **kwargs)
-        if is_new:
-            self.insert_at(self.parent, save=False, allow_existing_pk=True)
-        elif not self.parent and not old_parent:
+        old_parent_id = self._loaded_parent_id
+        if not is_new and (self._state.adding or old_parent_id is _UNKNOWN):
+            stored = self._cls.objects.filter(pk=self.pk). \
+                values_list('parent_id', flat=True)
+            if stored:
+                old_parent_id = stored[0]
+            else:
+                is_new = True
+        moved = not is_new and old_parent_id != self.parent_id
+        deferred = (is_new or moved) and _deferred_updates(self._cls)
+
+        if deferred:
+            # the subtree is regenerated when deferring ends
             pass
-        elif not self.parent or not old_parent:
-            self.move_to(self.parent)
-        elif old_parent.pk != self.parent.pk:
-            self.move_to(self.parent)
+        elif is_new or moved or self._loaded_level is _UNKNOWN:
+            parent_sort_key = self._set_tree_fields()
+        if moved and not deferred:
+            self._check_move_target(self.parent_id)
+        update_fields = kwargs.get('update_fields')
+        if moved and not deferred and update_fields is not None:
+            # set by _set_tree_fields() for the new parent
+            update_fields = list(update_fields) + [
+                name for name in ('parent', 'level', 'tree_id')
+                if name not in update_fields and
+                (name != 'tree_id' or self._tree_id)]
+        skipped = set()
+        if self._cache_counts:
+            skipped.update(('child_count', 'descendant_count'))
+        if not moved:
+            # the node (through another instance) or an ancestor may have
+            # moved since the node was loaded
+            skipped.update(('parent', 'level', 'tree_id'))
+        if self._sort_key:
+            # rewritten from stored keys by _sync_sort_key()
+            skipped.add('sort_key')
+        if skipped and not is_new:
+            # maintained in the database only, don't overwrite them with
+            # values loaded earlier
+            if update_fields is None:
+                update_fields = [
+                    f.name for f in self._meta.concrete_fields
+                    if not f.primary_key and f.attname in self.__dict__]
+            update_fields = [name for name in update_fields
+                             if name not in skipped]
+        if update_fields is not None:
+            kwargs['update_fields'] = update_fields
+
+        if deferred:
+            super(CTTModel, self).save(force_insert, force_update, using,
+                                       **kwargs)
+            deferred.add(self.pk, old_parent_id if moved else None)
+            self._mark_loaded()
+            # tree columns are stale until deferring ends
+            self._loaded_level = _UNKNOWN
+            return
 
-    def get_ancestors(self, ascending=False, include_self=False):
-        ancestors = self._cls.objects.filter(tpa__descendant_id=self.pk)
-        if not include_self:
-            ancestors = ancestors.exclude(id=self.pk)
-        if ascending:
-            ancestors = ancestors.order_by('tpa__path_len')
+        if not is_new and not moved:
+            if self._sort_key:
+                with transaction.atomic(using=using):
+                    super(CTTModel, self).save(force_insert, force_update,
+                                               using, **kwargs)
+                    # position among siblings may have changed
+                    self._sync_sort_key()
+            else:
+                super(CTTModel, self).save(force_insert, force_update, using,
+                                           **kwargs)
+            self._mark_loaded()
+            return
+
+        with transaction.atomic(using=using):
+            super(CTTModel, self).save(force_insert, force_update, using,
+                                       **kwargs)
+            if is_new:
+                self._insert(parent_sort_key)
+            else:
+                self._strategy.move_subtree(self, self.parent_id,
+                                            old_parent_id)
+                report_subtree_size(self._strategy.filter_descendants(
+                    self._cls.objects.all(), [self.pk], include_self=True))
+                if self._sort_key:
+                    self._sync_sort_key()
+        self._mark_loaded()
+
+    def _insert(self, parent_sort_key, changes=None):
+        """
+        Adds paths (and counts) of the saved node, level and tree_id must be
+        set by _set_tree_fields(). tree_id of roots and sort_key need the pk
+        and are written here with other changes ({name: value}).
+        """
+        changes = dict(changes or {})
+        if self._tree_id and self.parent_id is None and \
+                self.tree_id != self.pk:
+            changes['tree_id'] = self.tree_id = self.pk
+        if self._sort_key:
+            sort_key = parent_sort_key + self._get_sort_segment()
+            self._check_sort_key_length(len(sort_key))
+            if self.sort_key != sort_key:
+                changes['sort_key'] = self.sort_key = sort_key
+        if changes:
+            self._cls.objects.filter(pk=self.pk).update(**changes)
+
+        self._strategy.insert_node(self, self.parent_id)
+        report_subtree_size(1)
+        if self._cache_counts:
+            self._update_counts(1, self.parent_id)
+
+    def _get_sort_segment(self):
+        return self._sort_segment(
+            *[getattr(self, name) for name in self._sort_key_fields])
+
+    @classmethod
+    def _sort_segment(cls, pk):
+        """
+        Part of sort_key added by a node to the key of its parent, siblings
+        are ordered by it.
+        """
+        return '%08x' % pk
+
+    @classmethod
+    def _check_sort_key_length(cls, length):
+        """
+        Raises ValueError when a sort_key of length characters (deeper
+        levels have longer keys) does not fit in the column.
+        """
+        max_length = cls._meta.get_field('sort_key').max_length
+        if length > max_length:
+            raise ValueError(
+                _('Tree is too deep for sort_key: %(length)d characters '
+                  'needed, CTTMeta.sort_key_length is %(max_length)d.') %
+                {'length': length, 'max_length': max_length})
+
+    def _sync_sort_key(self):
+        """
+        Rewrites sort_key of the node and its descendants when the node got
+        a new parent or a new position among siblings. Stored keys of the
+        node and its stored parent are used, values loaded with them may be
+        stale.
+        """
+        old, prefix = self._cls.objects.filter(pk=self.pk). \
+            values_list('sort_key', 'parent__sort_key').get()
+        self.sort_key = (prefix or '') + self._get_sort_segment()
+        if self.sort_key != old:
+            self._replace_sort_key_prefixes({self.pk: self.sort_key},
+                                            len(old))
+
+    @classmethod
+    def _replace_sort_key_prefixes(cls, keys, old_length):
+        """
+        Replaces the first old_length characters of sort_key in the subtree
+        of each pk of keys ({pk: new key}, subtrees must not overlap) with
+        its new key, with one UPDATE per 200 subtrees.
+        """
+        connection = connections[router.db_for_write(cls._cls)]
+        if connection.vendor == 'mysql':
+            value = 'CONCAT(%s, SUBSTR({sort_key}, %d))'
         else:
-            ancestors = ancestors.order_by('-tpa__path_len')
+            value = '%s || SUBSTR({sort_key}, %d)'
+        growth = max(len(key) for key in keys.values()) - old_length
+        # 4 parameters per subtree, keep below sqlite limit of 999
+        for chunk in chunked(keys, 200):
+            if growth > 0:
+                # keys get longer when subtrees move deeper
+                longest, = cls._fetch_sql(
+                    'SELECT MAX(LENGTH({sort_key})) FROM {node} '
+                    'WHERE {pk} IN (SELECT {descendant} FROM {tp} '
+                    'WHERE {ancestor} IN (%s))' %
+                    ', '.join(['%s'] * len(chunk)), chunk)[0]
+                cls._check_sort_key_length(longest + growth)
+            params = []
+            for pk in chunk:
+                params.extend((pk, keys[pk]))
+            params.extend(chunk)
+            params.extend(chunk)
+            ids = ', '.join(['%s'] * len(chunk))
+            new = 'SELECT CASE tp.{ancestor} %s END FROM {tp} tp ' \
+                  'WHERE tp.{descendant} = {node}.{pk} ' \
+                  'AND tp.{ancestor} IN (%s)' % (
+                      ' '.join(['WHEN %s THEN %s'] * len(chunk)), ids)
+            cls._execute_sql(
+                'UPDATE {node} SET {sort_key} = ' +
+                value % ('(' + new + ')', old_length + 1) + ' '
+                'WHERE {pk} IN (SELECT {descendant} FROM {tp} '
+                'WHERE {ancestor} IN (' + ids + '))',
+                params)
+
+    @classmethod
+    def _fill_sort_keys(cls, nodes):
+        """
+        Computes sort_key of nodes (a queryset) level by level, parents
+        outside of nodes must have their keys already.
+        """
+        fields = ['pk', 'parent_id'] + [name for name in cls._sort_key_fields
+                                        if name != 'pk']
+        levels = nodes.order_by('level').values_list('level', flat=True). \
+            distinct()
+        keys = {}
+        for level in list(levels):
+            rows = list(nodes.filter(level=level).values_list(*fields))
+            missing = set(row[1] for row in rows
+                          if row[1] is not None and row[1] not in keys)
+            for pks in chunked(missing):
+                keys.update(cls._cls.objects.filter(pk__in=pks).
+                            values_list('pk', 'sort_key'))
+            level_keys = {}
+            for row in rows:
+                values = dict(zip(fields, row))
+                level_keys[row[0]] = keys.get(row[1], '') + cls._sort_segment(
+                    *[values[name] for name in cls._sort_key_fields])
+            if level_keys:
+                cls._check_sort_key_length(
+                    max(len(key) for key in level_keys.values()))
+            cls._update_by_pk('sort_key', level_keys)
+            keys = level_keys
+
+    @classmethod
+    def _update_by_pk(cls, column, values):
+        """
+        Sets column (a name of _format_sql) of nodes to values ({pk: value})
+        with one UPDATE per 300 nodes.
+        """
+        # 3 parameters per node, keep below sqlite limit of 999
+        for chunk in chunked(values, 300):
+            params = []
+            for pk in chunk:
+                params.extend((pk, values[pk]))
+            params.extend(chunk)
+            cls._execute_sql(
+                'UPDATE {node} SET {%s} = CASE {pk} %s END '
+                'WHERE {pk} IN (%s)' % (
+                    column, ' '.join(['WHEN %s THEN %s'] * len(chunk)),
+                    ', '.join(['%s'] * len(chunk))),
+                params)
+
+    def get_ancestors(self, ascending=False, include_self=False):
+        ancestors = self._strategy.filter_ancestors(
+            self._cls.objects.all(), [self.pk], include_self)
+        ancestors = ancestors.order_by('-level' if ascending else 'level')
+        prefetched = getattr(self, '_prefetched_objects_cache', {}). \
+            get('ancestors')
+        if prefetched is not None:
+            objs = list(prefetched)
+            if include_self:
+                objs.append(self)
+            if ascending:
+                objs.reverse()
+            ancestors = cached_qs(ancestors, objs)
         return ancestors
 
     @filtered_qs
     def get_children(self):
-        nodes = self._cls.objects.filter(
-            Q(tpd__ancestor_id=self.pk) & Q(tpd__path_len=1)
-        )
+        nodes = self._filter_subtree(self._cls.objects.all(), min_depth=1,
+                                     max_depth=1)
+        if hasattr(self, '_cached_children'):
+            nodes = cached_qs(nodes, self._cached_children)
         return nodes
 
     def get_descendant_count(self):
+        if hasattr(self, 'descendant_count'):
+            return self.descendant_count
         return self.get_descendants().count()
 
-    def get_descendants(self, include_self=False):
-        nodes = self._cls.objects.filter(tpd__ancestor_id=self.pk)
-        if not include_self:
-            nodes = nodes.exclude(id=self.pk)
+    def get_descendants(self, include_self=False, ordered=False,
+                        min_depth=None, max_depth=None):
+        """
+        With ordered=True (requires CTTMeta.sort_key) descendants come in
+        depth-first preorder straight from the database. min_depth and
+        max_depth limit levels below the node (path_len of the closure
+        table), min_depth=0 is include_self.
+        """
+        nodes = self._filter_subtree(self._cls.objects.all(), include_self,
+                                     min_depth, max_depth)
+        if ordered:
+            if not self._sort_key:
+                raise ValueError(_('Model has no sort_key column.'))
+            nodes = nodes.order_by('sort_key')
+        cached = self._get_cached_descendants()
+        if cached is not None:
+            if min_depth is None:
+                min_depth = 0 if include_self else 1
+            cached = [node for node in [self] + cached
+                      if node.level - self.level >= min_depth and
+                      (max_depth is None or
+                       node.level - self.level <= max_depth)]
+            nodes = cached_qs(nodes, cached)
         return nodes
 
+    def _filter_subtree(self, qs, include_self=False, min_depth=None,
+                        max_depth=None):
+        """
+        Narrows qs to the subtree of the node with the cheapest query: the
+        node and its children are found by pk and the indexed parent column,
+        deeper levels through the paths of the strategy.
+        """
+        if min_depth is None:
+            min_depth = 0 if include_self else 1
+        if max_depth is not None and min_depth > max_depth:
+            return qs.none()
+        if max_depth is not None and max_depth <= 1:
+            if min_depth > 0:
+                return qs.filter(parent_id=self.pk)
+            if max_depth == 0:
+                return qs.filter(pk=self.pk)
+            return qs.filter(Q(pk=self.pk) | Q(parent_id=self.pk))
+        return self._strategy.filter_descendants(qs, [self.pk], include_self,
+                                                 max_depth, min_depth)
+
+    def _get_cached_descendants(self):
+        """
+        Descendants in depth-first order from children cached by get_tree(),
+        None if some part of the subtree is not cached.
+        """
+        descendants = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if not hasattr(node, '_cached_children'):
+                return None
+            if node is not self:
+                descendants.append(node)
+            stack.extend(reversed(node._cached_children))
+        return descendants
+
+    def get_tree(self, max_depth=None):
+        """
+        Fetches the subtree (down to max_depth levels below the node) in one
+        query and caches children on every node, so get_children(),
+        get_descendants() and is_leaf_node() of the returned node and its
+        descendants don't hit the database. Returns self.
+        """
+        nodes = self._filter_subtree(self._cls.objects.all(),
+                                     include_self=True, max_depth=max_depth)
+        if self._sort_key:
+            nodes = nodes.order_by('sort_key')
+        nodes = [self if node.pk == self.pk else node for node in nodes]
+        cache_tree_children(nodes)
+        if max_depth is not None:
+            # children of the deepest fetched nodes are unknown
+            for node in nodes:
+                if node.level - self.level >= max_depth:
+                    del node._cached_children
+        return self
+
     def get_leafnodes(self, include_self=False):
-        nodes = self.get_descendants(include_self=include_self)
-        nodes = nodes.exclude(tpa__path_len__gt=0)
-        return nodes
+        return self._strategy.leaves(
+            self.get_descendants(include_self=include_self))
 
     def get_level(self):
         return self.level
 
-    def _get_next_from_qs(self, qs):
-        take = False
-        for item in qs:
-            if take:
-                return item
-            if item == self:
-                take = True
-        return None
-
     def get_next_sibling(self, **filters):
         """
-        jak chcesz mieć dobrą kolejność to korzystaj z CTTOrderableModel!
+        Siblings are ordered by pk, jak chcesz mieć dobrą kolejność to
+        korzystaj z CTTOrderableModel!
         """
-        siblings = self.get_siblings(include_self=True).filter(**filters)
-        return self._get_next_from_qs(siblings)
+        siblings = self.get_siblings().filter(pk__gt=self.pk, **filters)
+        return siblings.order_by('pk').first()
 
     def get_previous_sibling(self, **filters):
         """
-        jak chcesz mieć dobrą kolejność to korzystaj z CTTOrderableModel!
+        Siblings are ordered by pk, jak chcesz mieć dobrą kolejność to
+        korzystaj z CTTOrderableModel!
+        """
+        siblings = self.get_siblings().filter(pk__lt=self.pk, **filters)
+        return siblings.order_by('-pk').first()
+
+    @classmethod
+    def get_next_siblings(cls, nodes):
+        """
+        Next siblings of many nodes (instances or pks) at once, as
+        {pk: sibling or None}. Two queries per 500 nodes.
+        """
+        return cls._get_sibling_links(nodes, previous=False)
+
+    @classmethod
+    def get_previous_siblings(cls, nodes):
+        """
+        Previous siblings of many nodes at once, see get_next_siblings().
         """
-        siblings = self.get_siblings(include_self=True).filter(**filters)
-        return self._get_next_from_qs(siblings.reverse())
+        return cls._get_sibling_links(nodes, previous=True)
+
+    @classmethod
+    def _get_sibling_links(cls, nodes, previous):
+        connection = connections[router.db_for_read(cls._cls)]
+        sql = cls._format_sql(cls._sibling_sql(previous), connection)
+        links = {}
+        for pks in chunked(set(getattr(node, 'pk', node) for node in nodes)):
+            links.update(cls._cls.objects.filter(pk__in=pks).
+                         extra(select={'sibling_id': sql}).order_by().
+                         values_list('pk', 'sibling_id'))
+        siblings = {}
+        for pks in chunked(set(pk for pk in links.values() if pk is not None)):
+            siblings.update(cls._cls.objects.in_bulk(pks))
+        return dict((pk, siblings.get(sibling_id))
+                    for pk, sibling_id in links.items())
+
+    @classmethod
+    def _sibling_sql(cls, previous):
+        """
+        Correlated subquery selecting pk of the next (or previous) sibling.
+        """
+        return 'SELECT %s(sibling.{pk}) FROM {node} sibling ' \
+               'WHERE sibling.{parent} = {node}.{parent} ' \
+               'AND sibling.{pk} %s {node}.{pk}' % (
+                   ('MAX', '<') if previous else ('MIN', '>'))
 
     def get_siblings(self, include_self=False):
-        if not self.parent:
+        # parent_id is enough, the parent row is not loaded
+        if self.parent_id is None:
             nodes = self._cls.objects.filter(id=self.pk)
         else:
-            nodes = self._cls.objects.filter(
-                Q(tpd__ancestor_id=self.parent_id) & Q(tpd__path_len=1)
-            )
+            nodes = self._cls.objects.filter(parent_id=self.parent_id)
         if not include_self:
             nodes = nodes.exclude(id=self.pk)
         return nodes
 
     def get_root(self):
-        return self.tpd.latest('path_len').ancestor
-
+        if self._tree_id:
+            if self.tree_id == self.pk:
+                return self
+            return self._cls.objects.get(pk=self.tree_id)
+        return self._strategy.filter_ancestors(
+            self._cls.objects.all(), [self.pk], include_self=True). \
+            get(parent__isnull=True)
+
+    @instrumented('insert_at')
     def insert_at(self, target, position='first-child', save=False,
                   allow_existing_pk=False):
         """
@@ -140,42 +637,65 @@ class CTTModel(models.Model):
             raise ValueError(
                 _('Cannot insert a node which has already been saved.'))
 
+        deferred = _deferred_updates(self._cls)
+        if deferred:
+            if target:
+                self.parent = target
+            deferred.add(self.pk)
+            if save:
+                self.save()
+            return
+
         if target:
             self.parent = target
-            path = target.get_ancestors(ascending=True,
-                                        include_self=True).only('pk')
-        else:
-            path = []
-        tree_paths = [self._tpm(ancestor_id=self.pk, descendant_id=self.pk,
-                                path_len=0), ]
-        path_len = 1
-        for node in path:
-            tree_paths.append(
-                self._tpm(ancestor_id=node.pk, descendant_id=self.pk,
-                          path_len=path_len)
-            )
-            path_len += 1
-        self._tpm.objects.bulk_create(tree_paths)
+        names = ['level']
+        if self._tree_id:
+            names.append('tree_id')
+        old = [getattr(self, name) for name in names]
+        parent_sort_key = self._set_tree_fields()
+        self._insert(parent_sort_key, dict(
+            (name, getattr(self, name)) for name, value in zip(names, old)
+            if getattr(self, name) != value))
 
         if save:
             self.save()
 
 
     def is_ancestor_of(self, other, include_self=False):
-        nodes = other.get_ancestors(include_self=include_self)
-        return self in nodes
+        return self._path_exists(self.pk, other.pk, include_self)
 
     def is_child_node(self):
         return not self.is_root_node()
 
     def is_descendant_of(self, other, include_self=False):
-        nodes = other.get_descendants(include_self=include_self)
-        return self in nodes
+        return self._path_exists(other.pk, self.pk, include_self)
 
+    @classmethod
+    def _path_exists(cls, ancestor_id, descendant_id, include_self=False):
+        return cls._strategy.path_exists(ancestor_id, descendant_id,
+                                         include_self)
+
+    def filter_descendants(self, nodes, include_self=False):
+        """
+        Returns those of nodes (instances or pks) that are descendants of
+        this node, checked with one query per 500 nodes.
+        """
+        nodes = list(nodes)
+        found = set()
+        for pks in chunked(set(getattr(node, 'pk', node) for node in nodes)):
+            found.update(self._strategy.filter_descendants(
+                self._cls.objects.filter(pk__in=pks), [self.pk],
+                include_self).values_list('pk', flat=True))
+        return [node for node in nodes if getattr(node, 'pk', node) in found]
 
     def is_leaf_node(self):
-        return self._cls.objects.filter(
-            tpd__ancestor_id=self.pk).count() == 1
+        if hasattr(self, 'is_leaf'):
+            return bool(self.is_leaf)
+        if hasattr(self, 'child_count'):
+            return not self.child_count
+        if hasattr(self, '_cached_children'):
+            return not self._cached_children
+        return not self._strategy.has_children(self.pk)
 
     def is_root_node(self):
         return self.level == 0
@@ -199,171 +719,687 @@ class CTTModel(models.Model):
         :param others:
         :return:
         """
-        #        ancestors = self._cls.objects.filter(tpa__descendant_id=self.pk)
+        def ancestors(node):
+            return self._strategy.filter_ancestors(
+                self._cls.objects.all(), [node.pk], include_self=True)
+
         if others:
-            uni_ancestors = self._cls.objects.filter(
-                Q(tpa__descendant_id=target.id)
-                &
-                ~Q(tpa__descendant_id=self.pk)
-            )
+            uni_ancestors = ancestors(target).exclude(
+                pk__in=ancestors(self).values('pk'))
         else:
-            uni_ancestors = self._cls.objects.filter(
-                Q(tpa__descendant_id=self.pk)
-                &
-                ~Q(tpa__descendant_id=target.id)
-            )
+            uni_ancestors = ancestors(self).exclude(
+                pk__in=ancestors(target).values('pk'))
         if not include_self:
             uni_ancestors = uni_ancestors.exclude(id=self.pk)
         if not include_target:
             uni_ancestors = uni_ancestors.exclude(id=target.id)
         return uni_ancestors
 
-    def move_to(self, target, position='first-child'):
-        if self in target.get_ancestors(include_self=True):
+    def _check_move_target(self, target_id):
+        if target_id is not None and \
+                self._path_exists(self.pk, target_id, include_self=True):
             raise ValueError(_('Cannot move node to its descendant or itself.'))
 
-        old_parent = self._cls.objects.get(pk=self.pk).parent
-        if old_parent is target:
-            return
+    @instrumented('move_to')
+    def move_to(self, target, position='first-child'):
+        """
+        Moves node with its whole subtree under target (None makes it
+        a root). Closure rows are rewritten by save().
+        """
+        self.parent = target
+        self.save()
 
-        self.tpd.all().delete()
-        self.insert_at(target, save=True, allow_existing_pk=True)
+    def _update_counts(self, size, parent_id):
+        """
+        Adds size (subtree size, negative when it is taken away) to
+        descendant_count of node's ancestors and one to child_count of its
+        parent.
+        """
+        ancestors = self._tpm.objects.filter(
+            descendant_id=self.pk, path_len__gt=0).values('ancestor_id')
+        self._cls.objects.filter(pk__in=ancestors).update(
+            descendant_count=F('descendant_count') + size)
+        if parent_id is not None:
+            self._cls.objects.filter(pk=parent_id).update(
+                child_count=F('child_count') + (1 if size > 0 else -1))
+
+    @instrumented('delete')
+    def delete(self, using=None):
+        if not self._cache_counts:
+            return super(CTTModel, self).delete(using)
+        with transaction.atomic(using=using):
+            size = self._tpm.objects.filter(ancestor_id=self.pk).count()
+            self._update_counts(-size, self.parent_id)
+            super(CTTModel, self).delete(using)
+
+    def delete_subtree(self, send_signals=False):
+        """
+        Deletes the node with its descendants without loading them, see
+        TreeQuerySet.delete_subtrees(). Returns number of deleted nodes.
+        """
+        return self._delete_subtrees(
+            [self.pk], router.db_for_write(self._cls, instance=self),
+            send_signals)
 
-        descendants = self.get_descendants()
-        for node in descendants:
-            node.tpd.all().delete()
-            node.insert_at(node.parent, save=False, allow_existing_pk=True)
+    @classmethod
+    def _get_external_relations(cls):
+        """
+        Relations pointing to nodes other than parent and the closure table.
+        """
+        own = [cls._meta.get_field('parent')]
+        if cls._tpm is not None:
+            own += [cls._tpm._meta.get_field('ancestor'),
+                    cls._tpm._meta.get_field('descendant')]
+        return [related for related in cls._meta.get_all_related_objects(
+                include_hidden=True, include_proxy_eq=True)
+                if related.field not in own and
+                related.field.rel.on_delete is not models.DO_NOTHING]
 
     @classmethod
-    def _rebuild_tree(cls):
+    @instrumented('delete_subtrees')
+    def _delete_subtrees(cls, roots, using, send_signals=False):
         """
-        mało sprytne, ale pewne :)
-        :param cls:
-        :return:
+        Deletes subtrees of roots (pks or a pk subquery) with a constant
+        number of queries. Nodes are processed in chunks, deepest first, only
+        when signals are to be sent or other models refer to the nodes
+        (those relations are then handled by Django's Collector).
         """
-        cls._tpm.objects.all().delete()
-        for node in cls._cls.objects.all().order_by('level'):
-            node.insert_at(node.parent, allow_existing_pk=True)
+        nodes = cls._cls._base_manager.using(using)
+        subtree = cls._strategy.filter_descendants(nodes.all(), roots,
+                                                   include_self=True)
+        external = cls._get_external_relations()
+        chunked_delete = send_signals or external
+        with transaction.atomic(using=using):
+            if chunked_delete:
+                levels = list(subtree.order_by('-level').distinct().
+                              values_list('pk', 'level'))
+            # level -1 marks the subtree for the counts update and
+            # delete_marked_paths()
+            count = subtree.update(level=-1)
+            report_subtree_size(count)
+            if cls._cache_counts:
+                deleted_paths = \
+                    'FROM {tp} ctt_tp INNER JOIN {node} ctt_node ' \
+                    'ON ctt_node.{pk} = ctt_tp.{descendant} ' \
+                    'WHERE ctt_node.{level} = -1'
+                cls._execute_sql(
+                    'UPDATE {node} SET '
+                    '{descendant_count} = {descendant_count} - ('
+                    'SELECT COUNT(*) ' + deleted_paths + ' '
+                    'AND ctt_tp.{ancestor} = {node}.{pk}), '
+                    '{child_count} = {child_count} - ('
+                    'SELECT COUNT(*) FROM {node} ctt_node '
+                    'WHERE ctt_node.{parent} = {node}.{pk} '
+                    'AND ctt_node.{level} = -1) '
+                    'WHERE {level} <> -1 AND {pk} IN ('
+                    'SELECT ctt_tp.{ancestor} ' + deleted_paths + ')',
+                    using=using)
+            if not chunked_delete:
+                cls._strategy.delete_marked_paths(using)
+                cls._execute_sql('DELETE FROM {node} WHERE {level} = -1',
+                                 using=using)
+                return count
+
+            for chunk in chunked(levels):
+                pks = [pk for pk, level in chunk]
+                objs = []
+                if send_signals:
+                    objs = list(nodes.filter(pk__in=pks))
+                    original = dict(chunk)
+                    for obj in objs:
+                        obj.level = original[obj.pk]
+                        signals.pre_delete.send(sender=cls._cls,
+                                                instance=obj, using=using)
+                collector = Collector(using=using)
+                for related in external:
+                    field = related.field
+                    sub_objs = collector.related_objects(related, pks)
+                    if collector.can_fast_delete(sub_objs, from_field=field):
+                        collector.fast_deletes.append(sub_objs)
+                    elif sub_objs:
+                        field.rel.on_delete(collector, field, sub_objs, using)
+                collector.delete()
+                cls._strategy.delete_paths(pks, using)
+                cls._execute_sql('DELETE FROM {node} WHERE {pk} IN (%s)' %
+                                 ', '.join(['%s'] * len(pks)), pks,
+                                 using=using)
+                for obj in objs:
+                    signals.post_delete.send(sender=cls._cls, instance=obj,
+                                             using=using)
+            return count
 
     @classmethod
-    def _rebuild_qs(cls, qs):
+    def _rebuild_counts(cls, tree_id=None, pks=None):
         """
-        Przebudowuje wszystkie ścieżki przechodzące przez qs, powolne,
-        używaj _rebuild_tree chyba że wiesz co robisz.
+        Recounts child_count and descendant_count of all nodes (or nodes of
+        one tree, or given nodes with their ancestors) from the closure table.
         """
+        sql = 'UPDATE {node} SET ' \
+              '{descendant_count} = (' + \
+              cls._strategy.descendant_count_sql + '), ' \
+              '{child_count} = (' + cls._strategy.child_count_sql + ')'
+        if tree_id is not None:
+            cls._execute_sql(sql + ' WHERE {tree_id} = %s', [tree_id])
+        elif pks is not None:
+            for chunk in chunked(pks):
+                cls._execute_sql(
+                    sql + ' WHERE {pk} IN (SELECT ctt_path.{ancestor} '
+                    'FROM {tp} ctt_path WHERE ctt_path.{descendant} IN (%s))' %
+                    ', '.join(['%s'] * len(chunk)), chunk)
+        else:
+            cls._execute_sql(sql)
 
-        def item_descendants(item, result=None):
-            if not result:
-                result = []
+    @classmethod
+    def _check_counts(cls):
+        """
+        Returns nodes whose child_count or descendant_count drifted from the
+        closure table, annotated with actual_child_count and
+        actual_descendant_count.
+        """
+        connection = connections[router.db_for_read(cls._cls)]
+        descendant_count = cls._format_sql(
+            cls._strategy.descendant_count_sql, connection)
+        child_count = cls._format_sql(cls._strategy.child_count_sql,
+                                      connection)
+        where = cls._format_sql(
+            '{node}.{descendant_count} <> (%s) OR '
+            '{node}.{child_count} <> (%s)', connection) % (
+            descendant_count, child_count)
+        return cls._cls.objects.extra(
+            select={'actual_descendant_count': descendant_count,
+                    'actual_child_count': child_count},
+            where=[where])
 
-            children = list(cls._cls.objects.filter(parent=item))
-            result.extend(children)
-            for c in children:
-                item_descendants(c, result)
+    @classmethod
+    def _format_sql(cls, sql, connection):
+        """
+        Replaces {node}, {pk}, {parent}, {level}, {tp}, {ancestor},
+        {descendant} and {path_len} (closure table strategy only, and
+        {child_count}, {descendant_count} when counts are cached) in sql with
+        quoted table/column names. Subclasses add their own names in
+        _sql_names().
+        """
+        qn = connection.ops.quote_name
+        opts = cls._cls._meta
+        names = cls._sql_names(connection)
+        if cls._tpm is not None:
+            tp_opts = cls._tpm._meta
+            names.update(
+                tp=qn(tp_opts.db_table),
+                ancestor=qn(tp_opts.get_field('ancestor').column),
+                descendant=qn(tp_opts.get_field('descendant').column),
+                path_len=qn(tp_opts.get_field('path_len').column))
+        if cls._cache_counts:
+            names['child_count'] = qn(opts.get_field('child_count').column)
+            names['descendant_count'] = qn(
+                opts.get_field('descendant_count').column)
+        if cls._tree_id:
+            names['tree_id'] = qn(opts.get_field('tree_id').column)
+        if cls._sort_key:
+            names['sort_key'] = qn(opts.get_field('sort_key').column)
+        return sql.format(
+            node=qn(opts.db_table),
+            pk=qn(opts.pk.column),
+            parent=qn(opts.get_field('parent').column),
+            level=qn(opts.get_field('level').column),
+            **names
+        )
 
-            return result
+    @classmethod
+    def _sql_names(cls, connection):
+        """
+        Hook for _format_sql, returns additional {name: quoted name}.
+        """
+        return {}
 
-        def item_ancestors(item, result=None):
-            if not result:
-                result = []
+    @classmethod
+    def _execute_sql(cls, sql, params=(), using=None):
+        """
+        Runs raw sql (see _format_sql) against node and closure tables of
+        database using (routed for writes by default). Returns number of
+        affected rows.
+        """
+        connection = connections[using or router.db_for_write(cls._cls)]
+        cursor = connection.cursor()
+        cursor.execute(cls._format_sql(sql, connection), params)
+        return cursor.rowcount
 
-            while item:
-                result.append(item)
-                item = item.parent
+    @classmethod
+    def _fetch_sql(cls, sql, params=()):
+        """
+        Runs raw select sql (see _format_sql), returns list of rows.
+        """
+        connection = connections[router.db_for_read(cls._cls)]
+        cursor = connection.cursor()
+        cursor.execute(cls._format_sql(sql, connection), params)
+        return [tuple(row) for row in cursor.fetchall()]
 
-            return result
+    @classmethod
+    def _prepare_bulk_nodes(cls, nodes, batch_parents):
+        """
+        Hook for TreeManager.bulk_create_tree, called before nodes are
+        inserted. batch_parents maps id() of a node to its parent from the
+        batch.
+        """
+        pass
 
-        related_nodes = set()
-        for item in qs:
-            # Get parents:
-            related_nodes = related_nodes.union(item_ancestors(item))
-            related_nodes = related_nodes.union(item_descendants(item))
+    @classmethod
+    @instrumented('rebuild_tree')
+    def _rebuild_tree(cls, progress=None, tree_id=None):
+        """
+        Regenerates closure table (if any) and level column (and tree_id
+        column) from parent column, one INSERT ... SELECT per tree level.
+        :param progress: optional callable(level, nodes_count) called after
+            each level is done
+        :param tree_id: rebuild only the tree with given tree_id (requires
+            CTTMeta.tree_id), its root row is locked for the rebuild
+        Raises ValueError when the parent column contains a cycle.
+        """
+        nodes = cls._cls.objects.all()
+        if tree_id is not None:
+            if not cls._tree_id:
+                raise ValueError(_('Model has no tree_id column.'))
+            nodes = nodes.filter(tree_id=tree_id)
+        with transaction.atomic(using=router.db_for_write(cls._cls)):
+            if tree_id is not None:
+                list(nodes.select_for_update().filter(pk=tree_id).
+                     values_list('pk'))
+            cls._strategy.clear_paths(tree_id)
+            report_subtree_size(nodes.update(level=-1))
+            level = 0
+            count = nodes.filter(parent__isnull=True).update(level=0)
+            if cls._tree_id and tree_id is None:
+                nodes.filter(level=0).update(tree_id=F(cls._meta.pk.attname))
+            while count:
+                cls._strategy.insert_level_paths(level, tree_id)
+                if progress:
+                    progress(level, count)
+                level += 1
+                count = nodes.filter(level=-1, parent__level=level - 1). \
+                    update(level=level)
+                if count and cls._tree_id and tree_id is None:
+                    cls._execute_sql(
+                        'UPDATE {node} SET {tree_id} = ('
+                        'SELECT parent.{tree_id} FROM {node} parent '
+                        'WHERE parent.{pk} = {node}.{parent}'
+                        ') WHERE {level} = %s', [level])
+            if nodes.filter(level=-1).exists():
+                # not reachable from any root, rolled back
+                raise ValueError(_('Parent column contains a cycle.'))
+            if cls._cache_counts:
+                cls._rebuild_counts(tree_id)
+            if cls._sort_key:
+                cls._fill_sort_keys(nodes)
 
-        tpms = cls._tpm.objects.filter(
-            ancestor__in=related_nodes,
-            descendant__in=related_nodes)
+    @classmethod
+    def tree_updates_deferred(cls):
+        """
+        with Node.tree_updates_deferred(): ... - defers path maintenance of
+        inserts and moves to one set-based update on exit, see
+        ctt.models.tree_updates_deferred().
+        """
+        return tree_updates_deferred([cls])
 
-        tpms.delete()
+    @classmethod
+    def _check_tree(cls):
+        """
+        Compares stored paths, level (and tree_id) columns with the parent
+        column, with a few set-based queries. Returns a dict of lists, all
+        empty for a consistent tree: closure rows as (ancestor_id,
+        descendant_id) under 'missing', 'extra', 'path_len' (and
+        'path_tree_id', closure table strategy only) and pks of nodes with
+        stale 'level' (and 'tree_id', 'sort_key' not extending the key of
+        the parent by one segment).
+        """
+        report = cls._strategy.check_paths()
+        parent = 'SELECT parent.{%s} FROM {node} parent ' \
+                 'WHERE parent.{pk} = {node}.{parent}'
+        report['level'] = [pk for pk, in cls._fetch_sql(
+            'SELECT {pk} FROM {node} WHERE {level} <> '
+            'COALESCE((' + parent % 'level' + ') + 1, 0)')]
+        if cls._tree_id:
+            report['tree_id'] = [pk for pk, in cls._fetch_sql(
+                'SELECT {pk} FROM {node} WHERE {tree_id} IS NULL OR '
+                '{tree_id} <> COALESCE((' + parent % 'tree_id' + '), {pk})')]
+        if cls._sort_key:
+            segment = len(cls._sort_segment(*[0] * len(cls._sort_key_fields)))
+            prefix = '(' + parent % 'sort_key' + ')'
+            report['sort_key'] = [pk for pk, in cls._fetch_sql(
+                'SELECT {pk} FROM {node} WHERE {sort_key} IS NULL OR '
+                'LENGTH({sort_key}) <> COALESCE(LENGTH(' + prefix + '), 0) + '
+                '%s OR SUBSTR({sort_key}, 1, LENGTH(' + prefix + ')) <> ' +
+                prefix, [segment])]
+        return report
 
-        for node in sorted(related_nodes, key=lambda i: i.level):
-            node.insert_at(node.parent, allow_existing_pk=True)
+    @classmethod
+    def _repair_tree(cls, report=None):
+        """
+        Rewrites subtrees of nodes found broken by _check_tree() (or given
+        report of it). Returns number of rewritten nodes.
+        """
+        if report is None:
+            report = cls._check_tree()
+        broken = set()
+        for name, rows in report.items():
+            if name in ('level', 'tree_id', 'sort_key'):
+                broken.update(rows)
+            else:
+                broken.update(descendant_id for ancestor_id, descendant_id
+                              in rows)
+        if not broken:
+            return 0
+        return cls._repair_subtrees(broken)
+
+    @classmethod
+    @instrumented('repair_subtrees')
+    def _repair_subtrees(cls, roots):
+        """
+        Regenerates paths, level (tree_id, sort_key and counts) of subtrees of
+        roots (pks) from the parent column, one INSERT ... SELECT per level
+        of the subtrees. Other nodes are not touched, paths of parents of
+        roots must be consistent. Returns number of rewritten nodes.
+        """
+        nodes = cls._cls.objects.all()
+        using = router.db_for_write(cls._cls)
+        with transaction.atomic(using=using):
+            # level -1 marks nodes to regenerate, placed ones get their
+            # level back level by level like in _rebuild_tree()
+            for pks in chunked(set(roots)):
+                nodes.filter(pk__in=pks).update(level=-1)
+            while nodes.filter(parent__level=-1).exclude(level=-1). \
+                    update(level=-1):
+                pass
+            repaired = list(nodes.filter(level=-1).values_list('pk',
+                                                               flat=True))
+            report_subtree_size(len(repaired))
+            cls._strategy.delete_marked_paths(using)
+            # nodes whose parents are placed get -2 while being placed
+            while nodes.filter(level=-1).filter(
+                    Q(parent__isnull=True) | Q(parent__level__gte=0)). \
+                    update(level=-2):
+                if cls._tree_id:
+                    cls._execute_sql(
+                        'UPDATE {node} SET {tree_id} = COALESCE(('
+                        'SELECT parent.{tree_id} FROM {node} parent '
+                        'WHERE parent.{pk} = {node}.{parent}'
+                        '), {pk}) WHERE {level} = -2')
+                cls._strategy.insert_level_paths(-2)
+                if cls._sort_key:
+                    cls._fill_sort_keys(nodes.filter(level=-2))
+                cls._execute_sql(
+                    'UPDATE {node} SET {level} = COALESCE(('
+                    'SELECT parent.{level} FROM {node} parent '
+                    'WHERE parent.{pk} = {node}.{parent}'
+                    ') + 1, 0) WHERE {level} = -2')
+            if nodes.filter(level=-1).exists():
+                raise ValueError(_('Parent column contains a cycle.'))
+            if cls._cache_counts:
+                cls._rebuild_counts(pks=repaired)
+        return len(repaired)
+
+    @classmethod
+    @instrumented('rebuild_qs')
+    def _rebuild_qs(cls, qs):
+        """
+        Rebuilds paths of subtrees of nodes of qs with _repair_subtrees().
+        Ancestors of the nodes are found walking the parent column, one
+        query per level, the topmost ancestor with stale paths or level (or
+        tree_id) is repaired with its subtree as well. Returns number of
+        rewritten nodes.
+        """
+        nodes = cls._cls.objects.all()
+        fields = ['pk', 'parent_id', 'level']
+        if cls._tree_id:
+            fields.append('tree_id')
+        roots = set(qs.values_list('pk', flat=True))
+        rows = {}
+        pks = roots
+        while pks:
+            for chunk in chunked(pks):
+                rows.update((row[0], row) for row in
+                            nodes.filter(pk__in=chunk).values_list(*fields))
+            pks = set(row[1] for row in rows.values()
+                      if row[1] is not None) - set(rows)
+
+        # ancestors of every fetched node, root first, with the node itself
+        chains = {}
+        for pk in rows:
+            path = []
+            current = pk
+            while current is not None and current not in chains and \
+                    current not in path:
+                path.append(current)
+                current = rows[current][1]
+            chain = [] if current is None else chains.get(current)
+            for node in reversed(path):
+                # None in a cycle of the parent column
+                chain = None if chain is None else chain + [node]
+                chains[node] = chain
+
+        ancestors = set(rows) - roots
+        broken = set(pk for pk in ancestors if chains[pk] is None or
+                     rows[pk][2] != len(chains[pk]) - 1 or
+                     (cls._tree_id and rows[pk][3] != chains[pk][0]))
+        if cls._tpm is not None:
+            paths = dict((pk, set()) for pk in ancestors)
+            path_fields = ['descendant_id', 'ancestor_id', 'path_len']
+            if cls._tree_id:
+                path_fields.append('tree_id')
+            for chunk in chunked(ancestors):
+                for row in cls._tpm.objects.filter(descendant_id__in=chunk). \
+                        values_list(*path_fields):
+                    paths[row[0]].add(row[1:])
+            for pk in ancestors - broken:
+                chain = chains[pk]
+                expected = set(
+                    (ancestor_id, len(chain) - 1 - i) +
+                    ((chain[0],) if cls._tree_id else ())
+                    for i, ancestor_id in enumerate(chain))
+                if paths[pk] != expected:
+                    broken.add(pk)
+        for pk in broken:
+            if chains[pk] is None:
+                roots.add(pk)
+            elif not broken.intersection(chains[pk][:-1]):
+                roots.add(pk)
+        if not roots:
+            return 0
+        return cls._repair_subtrees(roots)
 
 
 class CTTOrderableModel(CTTModel):
     order = models.IntegerField(verbose_name=_(u"order"))
     _interval = 10
+    _sort_key_fields = ('order', 'pk')
 
     class Meta:
         abstract = True
         ordering = ('order',)
+        index_together = [
+            ['parent', 'level'],
+            ['parent', 'order'],
+        ]
 
     def get_next_sibling(self, **filters):
         siblings = self.get_siblings().filter(**filters)
-        ret_node = siblings.filter(order__gt=self.order)
-        if not ret_node:
-            return None
-        return ret_node[0]
+        siblings = siblings.filter(
+            Q(order__gt=self.order) | Q(order=self.order, pk__gt=self.pk))
+        return siblings.order_by('order', 'pk').first()
 
     def get_previous_sibling(self, **filters):
         siblings = self.get_siblings().filter(**filters)
-        ret_node = siblings.filter(order__lt=self.order).reverse()
-        if not ret_node:
-            return None
-        return ret_node[0]
+        siblings = siblings.filter(
+            Q(order__lt=self.order) | Q(order=self.order, pk__lt=self.pk))
+        return siblings.order_by('-order', '-pk').first()
 
-    def get_children(self):
-        return super(CTTOrderableModel, self).get_children().order_by('order')
+    @classmethod
+    def _sibling_sql(cls, previous):
+        return 'SELECT sibling.{pk} FROM {node} sibling ' \
+               'WHERE sibling.{parent} = {node}.{parent} ' \
+               'AND (sibling.{order} %(cmp)s {node}.{order} ' \
+               'OR (sibling.{order} = {node}.{order} ' \
+               'AND sibling.{pk} %(cmp)s {node}.{pk})) ' \
+               'ORDER BY sibling.{order} %(dir)s, sibling.{pk} %(dir)s ' \
+               'LIMIT 1' % ({'cmp': '<', 'dir': 'DESC'} if previous
+                            else {'cmp': '>', 'dir': 'ASC'})
+
+    @classmethod
+    def _sort_segment(cls, order, pk):
+        # shifted, so negative orders sort first
+        return '%08x%08x' % (order + 2 ** 31, pk)
+
+    @classmethod
+    def _sql_names(cls, connection):
+        return {'order': connection.ops.quote_name(
+            cls._meta.get_field('order').column)}
+
+    def get_children(self, *args, **kwargs):
+        children = super(CTTOrderableModel, self).get_children(*args,
+                                                               **kwargs)
+        if children._result_cache is None:
+            children = children.order_by('order')
+        return children
 
     def get_siblings(self, include_self=False):
         return super(CTTOrderableModel, self).get_siblings(
             include_self).order_by('order')
 
+    @instrumented('save')
     def save(self, force_insert=False, force_update=False, using=None,
              **kwargs):
         self._fix_order()
         super(CTTOrderableModel, self).save(force_insert, force_update, using,
                                             **kwargs)
 
-    def _push_forward(self, from_pos):
-        new_order = from_pos + self._interval
-        siblings = self.get_siblings()
-        to_push = siblings.filter(order__gt=self.order, order__lte=new_order). \
-            order_by('order')
-        if to_push.exists():
-            to_push[0]._push_forward(new_order)
-
-        self.order = new_order
-        self.save()
-
+    @classmethod
+    def _prepare_bulk_nodes(cls, nodes, batch_parents):
+        """
+        Fills missing order the way _fix_order does: roots get 0, other nodes
+        are appended after their last sibling.
+        """
+        groups = {}
+        for node in nodes:
+            if node.order is not None:
+                continue
+            parent = batch_parents.get(id(node))
+            if parent is not None:
+                key = (True, id(parent))
+            else:
+                key = (False, node.parent_id)
+            groups.setdefault(key, []).append(node)
+
+        last_orders = {}
+        saved_parents = [key[1] for key in groups
+                         if not key[0] and key[1] is not None]
+        for ids in chunked(saved_parents):
+            last_orders.update(
+                cls._cls.objects.filter(parent_id__in=ids).order_by().
+                values_list('parent_id').annotate(Max('order')))
+
+        for (in_batch, parent_id), group in groups.items():
+            if not in_batch and parent_id is None:
+                for node in group:
+                    node.order = 0
+                continue
+            order = 0
+            if not in_batch and parent_id in last_orders:
+                order = last_orders[parent_id] + cls._interval
+            for node in group:
+                node.order = order
+                order += cls._interval
+
+    @instrumented('move_before')
     def move_before(self, sibling):
-        before = self.get_siblings().filter(order__lt=sibling.order). \
-            order_by('-order')
-        if before.exists():
-            self.order = before[0].order + 1
-        else:
-            self.order = sibling.order - self._interval
+        lower = self._get_sibling_group(sibling).filter(
+            Q(order__lt=sibling.order) |
+            Q(order=sibling.order, pk__lt=sibling.pk)
+        ).order_by('-order', '-pk').first()
+        self._place_between(lower, sibling)
         self.save()
 
+    @instrumented('move_after')
     def move_after(self, sibling):
-        self.order = sibling.order + 1
+        upper = self._get_sibling_group(sibling).filter(
+            Q(order__gt=sibling.order) |
+            Q(order=sibling.order, pk__gt=sibling.pk)
+        ).order_by('order', 'pk').first()
+        self._place_between(sibling, upper)
         self.save()
 
-    def _fix_order(self):
-        if not self.order:
-            if self.get_siblings().exists():
-                max_order_sibling = self.get_siblings().order_by('-order')[0]
-                self.order = max_order_sibling.order + self._interval
-            else:
-                self.order = 0
+    def _get_sibling_group(self, sibling=None):
+        """
+        Siblings of sibling (self by default) without self.
+        """
+        sibling = sibling or self
+        if sibling.parent_id is None:
+            return self._cls.objects.none()
+        return self._cls.objects.filter(parent_id=sibling.parent_id). \
+            exclude(pk=self.pk)
 
-        self._check_order_conflicts()
+    def _place_between(self, lower, upper):
+        """
+        Sets order in the middle of the gap between lower and upper siblings
+        (either can be None). When the gap is exhausted, the sibling group is
+        respaced first, so repeated moves cost O(1) writes amortised.
+        """
+        if lower is not None and upper is not None and \
+                upper.order - lower.order < 2:
+            orders = self._rebalance_siblings(upper)
+            lower.order, upper.order = orders[lower.pk], orders[upper.pk]
+
+        if lower is None and upper is None:
+            self.order = 0
+        elif lower is None:
+            self.order = upper.order - self._interval
+        elif upper is None:
+            self.order = lower.order + self._interval
+        else:
+            self.order = (lower.order + upper.order) // 2
+
+    @instrumented('rebalance_siblings')
+    def _rebalance_siblings(self, sibling=None):
+        """
+        Respaces orders of the sibling group (without self) _interval apart,
+        keeping their sequence. Returns {pk: new order}.
+        """
+        siblings = self._get_sibling_group(sibling).order_by('order', 'pk')
+        if self._sort_key:
+            rows = list(siblings.values_list('pk', 'sort_key'))
+        else:
+            rows = [(pk, None) for pk in siblings.values_list('pk', flat=True)]
+        pks = [pk for pk, sort_key in rows]
+        report_subtree_size(len(pks))
+        orders = dict((pk, i * self._interval) for i, pk in enumerate(pks))
+        self._update_by_pk('order', orders)
+        if self._sort_key:
+            keys = {}
+            for pk, old in rows:
+                segment = self._sort_segment(orders[pk], pk)
+                new = old[:-len(segment)] + segment
+                if new != old:
+                    keys[pk] = new
+            if keys:
+                # siblings share the parent prefix
+                self._replace_sort_key_prefixes(keys, len(rows[0][1]))
+        return orders
+
+    @instrumented('fix_order')
+    def _fix_order(self):
+        if self.order is None:
+            last = self._get_sibling_group().order_by('-order', '-pk').first()
+            self._place_between(last, None)
+        else:
+            self._check_order_conflicts()
 
     def _check_order_conflicts(self):
-        q = self.get_siblings()
-        if self.pk:
-            q = q.exclude(pk=self.pk)
-
-        conflicts = q.filter(order=self.order)
-        if conflicts.exists():
-            candidates = q.filter(order__gte=self.order)
-            candidates.update(order=F('order') + 1)
+        """
+        Node saved with order of an existing sibling goes into the gap right
+        before that sibling.
+        """
+        siblings = self._get_sibling_group()
+        upper = siblings.filter(order=self.order).order_by('pk').first()
+        if upper is None:
+            return
+        lower = siblings.filter(order__lt=self.order). \
+            order_by('-order', '-pk').first()
+        self._place_between(lower, upper)
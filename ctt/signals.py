@@ -0,0 +1,12 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+#vim: set ts=4 sw=4 et fdm=marker : */
+from django.dispatch import Signal
+
+# Sent by tree mutations (see ctt.instrumentation) when they are done, only
+# if there are receivers for the sender (the tree model). Nested operations
+# (insert_at() called by save() etc.) are included in the outermost one.
+tree_operation = Signal(providing_args=[
+    'operation', 'node', 'pk', 'subtree_size', 'paths_deleted',
+    'paths_inserted', 'queries', 'rows_written', 'elapsed',
+], use_caching=True)
@@ -0,0 +1,527 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set ts=4 sw=4 et fdm=marker : */
+"""
+Storage strategies of tree paths, chosen per model with
+ctt.register(Model, strategy=...).
+"""
+from django.db import connections, router
+from django.db.models import F
+from django.db.models.query import QuerySet
+from django.db.utils import NotSupportedError
+from django.utils.translation import ugettext as _
+
+
+class TreeStrategy(object):
+    """
+    Queries and path maintenance used by CTTModel, TreeQuerySet and
+    TreeManager. An instance is kept as model._strategy by ctt.register().
+    """
+    uses_closure_table = False
+
+    # correlated subqueries selected by TreeQuerySet.with_*()
+    child_count_sql = 'SELECT COUNT(*) FROM {node} ctt_node ' \
+                      'WHERE ctt_node.{parent} = {node}.{pk}'
+    descendant_count_sql = None
+    is_leaf_sql = 'CASE WHEN EXISTS (SELECT 1 FROM {node} ctt_node ' \
+                  'WHERE ctt_node.{parent} = {node}.{pk}) THEN 0 ELSE 1 END'
+
+    def __init__(self, model):
+        self.model = model
+
+    def format_sql(self, sql, connection):
+        return self.model._format_sql(sql, connection)
+
+    # reads
+
+    def filter_descendants(self, qs, roots, include_self=False,
+                           max_depth=None, min_depth=None):
+        """
+        Narrows qs to descendants of any of roots (a list of pks or a pk
+        queryset), min_depth (0 with include_self, 1 by default) to
+        max_depth levels below them.
+        """
+        raise NotImplementedError
+
+    def descendants_by_root(self, qs, roots, min_depth=1, max_depth=None):
+        """
+        (root pk, node) pairs of nodes of qs min_depth to max_depth levels
+        below any of roots (pks), fetched with one query, level by level in
+        sibling order (preorder with CTTMeta.sort_key).
+        """
+        raise NotImplementedError
+
+    def filter_ancestors(self, qs, nodes, include_self=False):
+        """
+        Narrows qs to ancestors of any of nodes (a list of pks or a pk
+        queryset).
+        """
+        raise NotImplementedError
+
+    def leaves(self, qs):
+        sql = self.format_sql(
+            'NOT EXISTS (SELECT 1 FROM {node} ctt_node '
+            'WHERE ctt_node.{parent} = {node}.{pk})', connections[qs.db])
+        return qs.extra(where=[sql])
+
+    def path_exists(self, ancestor_id, descendant_id, include_self=False):
+        return self.filter_ancestors(
+            self.model._cls.objects.filter(pk=ancestor_id), [descendant_id],
+            include_self).exists()
+
+    def has_children(self, pk):
+        return self.model._cls.objects.filter(parent_id=pk).exists()
+
+    def prefetch_ancestors(self, instances):
+        """
+        Ancestors of all instances, root first, each with _ancestor_of set to
+        pk of the instance it was fetched for.
+        """
+        raise NotImplementedError
+
+    def check_paths(self):
+        """
+        Stored paths disagreeing with the parent column, see
+        CTTModel._check_tree().
+        """
+        return {}
+
+    # writes, called after the node row is saved
+
+    def insert_node(self, node, target_id):
+        pass
+
+    def move_subtree(self, node, target_id, old_parent_id):
+        raise NotImplementedError
+
+    def insert_new_paths(self, level):
+        """
+        Paths of nodes at level inserted by TreeManager.bulk_create_tree().
+        """
+        pass
+
+    def clear_paths(self, tree_id=None):
+        pass
+
+    def insert_level_paths(self, level, tree_id=None):
+        """
+        Paths of nodes at level, called by _rebuild_tree() level by level.
+        """
+        pass
+
+    def delete_paths(self, pks, using):
+        pass
+
+    def delete_marked_paths(self, using):
+        """
+        Paths of nodes marked with level -1 by _delete_subtrees() and
+        _repair_subtrees().
+        """
+        pass
+
+
+def _ids_sql(ids, using):
+    """
+    SQL and params of a list of pks or a pk queryset, for IN (...).
+    """
+    if isinstance(ids, QuerySet):
+        return ids.query.get_compiler(using=ids.db).as_sql()
+    ids = list(ids)
+    return ', '.join(['%s'] * len(ids)) or 'NULL', ids
+
+
+class ClosureTableStrategy(TreeStrategy):
+    """
+    Every ancestor - descendant pair is stored in the TreePath model generated
+    by ctt.register(), reads are single joins. The table has a row per node
+    and each of its ancestors.
+    """
+    uses_closure_table = True
+
+    # children are read from the parent column, see TreeStrategy
+    descendant_count_sql = 'SELECT COUNT(*) - 1 FROM {tp} ctt_tp ' \
+                           'WHERE ctt_tp.{ancestor} = {node}.{pk}'
+
+    def _paths(self, include_self, max_depth, prefix='', min_depth=None):
+        lookup = {}
+        if min_depth is None:
+            min_depth = 0 if include_self else 1
+        if min_depth > 0:
+            lookup[prefix + 'path_len__gte'] = min_depth
+        if max_depth is not None:
+            lookup[prefix + 'path_len__lte'] = max_depth
+        return lookup
+
+    def filter_descendants(self, qs, roots, include_self=False,
+                           max_depth=None, min_depth=None):
+        if isinstance(roots, (list, tuple)) and len(roots) == 1:
+            lookup = self._paths(include_self, max_depth, 'tpd__', min_depth)
+            lookup['tpd__ancestor_id'] = roots[0]
+            return qs.filter(**lookup)
+        paths = self.model._tpm.objects.filter(
+            ancestor_id__in=roots,
+            **self._paths(include_self, max_depth, min_depth=min_depth))
+        return qs.filter(pk__in=paths.values('descendant_id'))
+
+    def descendants_by_root(self, qs, roots, min_depth=1, max_depth=None):
+        # path_len is indexed together with ancestor
+        paths = self.model._tpm.objects.using(qs.db).filter(
+            ancestor_id__in=roots,
+            **self._paths(False, max_depth, min_depth=min_depth))
+        if qs.query.where:
+            paths = paths.filter(descendant__in=qs.values('pk'))
+        if self.model._sort_key:
+            order = ['descendant__sort_key']
+        else:
+            order = ['path_len'] + ['descendant__' + name for name
+                                    in self.model._sort_key_fields]
+        return [(path.ancestor_id, path.descendant) for path in
+                paths.select_related('descendant').order_by(*order)]
+
+    def filter_ancestors(self, qs, nodes, include_self=False):
+        if isinstance(nodes, (list, tuple)) and len(nodes) == 1:
+            lookup = self._paths(include_self, None, 'tpa__')
+            lookup['tpa__descendant_id'] = nodes[0]
+            return qs.filter(**lookup)
+        paths = self.model._tpm.objects.filter(
+            descendant_id__in=nodes, **self._paths(include_self, None))
+        return qs.filter(pk__in=paths.values('ancestor_id'))
+
+    def path_exists(self, ancestor_id, descendant_id, include_self=False):
+        # single EXISTS on the (ancestor, descendant) unique index
+        paths = self.model._tpm.objects.filter(ancestor_id=ancestor_id,
+                                               descendant_id=descendant_id)
+        if not include_self:
+            paths = paths.filter(path_len__gt=0)
+        return paths.exists()
+
+    def prefetch_ancestors(self, instances):
+        paths = self.model._tpm.objects.filter(
+            descendant_id__in=[instance.pk for instance in instances],
+            path_len__gt=0
+        ).select_related('ancestor').order_by('-path_len')
+        ancestors = []
+        for path in paths:
+            path.ancestor._ancestor_of = path.descendant_id
+            ancestors.append(path.ancestor)
+        return ancestors
+
+    def _columns(self):
+        """
+        Closure columns to insert, with tree_id select fragment.
+        """
+        if self.model._tree_id:
+            return '{ancestor}, {descendant}, {path_len}, {tree_id}', \
+                   ', node.{tree_id}'
+        return '{ancestor}, {descendant}, {path_len}', ''
+
+    def insert_node(self, node, target_id):
+        # self path plus target's paths copied with path_len + 1,
+        # all in one statement
+        if node._tree_id:
+            sql = 'INSERT INTO {tp} ' \
+                  '({ancestor}, {descendant}, {path_len}, {tree_id}) ' \
+                  'SELECT %s, %s, 0, %s'
+            params = [node.pk, node.pk, node.tree_id]
+            copied = '{ancestor}, %s, {path_len} + 1, %s'
+            copied_params = [node.pk, node.tree_id]
+        else:
+            sql = 'INSERT INTO {tp} ({ancestor}, {descendant}, {path_len}) ' \
+                  'SELECT %s, %s, 0'
+            params = [node.pk, node.pk]
+            copied = '{ancestor}, %s, {path_len} + 1'
+            copied_params = [node.pk]
+        if target_id is not None:
+            sql += ' UNION ALL SELECT ' + copied + ' FROM {tp} ' \
+                   'WHERE {descendant} = %s'
+            params += copied_params + [target_id]
+        self.model._execute_sql(sql, params)
+
+    def move_subtree(self, node, target_id, old_parent_id):
+        """
+        Rewrites closure rows of the subtree in a constant number of queries:
+        paths crossing the subtree boundary are deleted, then the ancestor
+        chain of the target is cross-joined with the subtree paths. Levels
+        of descendants are set from their path_len with one UPDATE.
+        """
+        tp_objects = self.model._tpm.objects
+        subtree = tp_objects.filter(ancestor_id=node.pk). \
+            values('descendant_id')
+        if node._cache_counts:
+            size = subtree.count()
+            node._update_counts(-size, old_parent_id)
+        tp_objects.filter(descendant_id__in=subtree). \
+            exclude(ancestor_id__in=subtree).delete()
+        if target_id is not None:
+            columns, tree_id = self._columns()
+            params = [target_id, node.pk]
+            if tree_id:
+                # save() has set tree_id of the target's tree
+                tree_id = ', %s'
+                params.insert(0, node.tree_id)
+            self.model._execute_sql(
+                'INSERT INTO {tp} (' + columns + ') '
+                'SELECT supertree.{ancestor}, subtree.{descendant}, '
+                'supertree.{path_len} + subtree.{path_len} + 1' + tree_id +
+                ' FROM {tp} supertree, {tp} subtree '
+                'WHERE supertree.{descendant} = %s '
+                'AND subtree.{ancestor} = %s',
+                params)
+            if node._cache_counts:
+                node._update_counts(size, target_id)
+        self.model._execute_sql(
+            'UPDATE {node} SET {level} = %s + ('
+            'SELECT {path_len} FROM {tp} '
+            'WHERE {ancestor} = %s AND {descendant} = {node}.{pk}'
+            ') WHERE {pk} IN ('
+            'SELECT {descendant} FROM {tp} '
+            'WHERE {ancestor} = %s AND {path_len} > 0)',
+            [node.level, node.pk, node.pk])
+        if node._tree_id:
+            # save() has set tree_id of the new tree, tree_id loaded with
+            # the node may be stale, so the stored one is compared
+            self.model._cls.objects.filter(pk__in=subtree). \
+                exclude(tree_id=node.tree_id).update(tree_id=node.tree_id)
+            tp_objects.filter(descendant_id__in=subtree). \
+                exclude(tree_id=node.tree_id).update(tree_id=node.tree_id)
+
+    def insert_new_paths(self, level):
+        columns, tree_id = self._columns()
+        # new nodes are the only ones without closure rows
+        self.model._execute_sql(
+            'INSERT INTO {tp} (' + columns + ') '
+            'SELECT node.{pk}, node.{pk}, 0' + tree_id +
+            ' FROM {node} node '
+            'WHERE node.{level} = %s AND NOT EXISTS ('
+            'SELECT 1 FROM {tp} own WHERE own.{descendant} = node.{pk}'
+            ') UNION ALL '
+            'SELECT tp.{ancestor}, node.{pk}, tp.{path_len} + 1' +
+            tree_id + ' FROM {node} node '
+            'INNER JOIN {tp} tp ON tp.{descendant} = node.{parent} '
+            'WHERE node.{level} = %s AND NOT EXISTS ('
+            'SELECT 1 FROM {tp} own WHERE own.{descendant} = node.{pk}'
+            ')',
+            [level, level])
+
+    def clear_paths(self, tree_id=None):
+        paths = self.model._tpm.objects.all()
+        if tree_id is not None:
+            paths = paths.filter(tree_id=tree_id)
+        paths.delete()
+
+    def insert_level_paths(self, level, tree_id=None):
+        columns, node_tree_id = self._columns()
+        root_tree_id = node_tree_id.replace('node.', '')
+        self.model._execute_sql(
+            'INSERT INTO {tp} (' + columns + ') '
+            'SELECT {pk}, {pk}, 0' + root_tree_id + ' FROM {node} '
+            'WHERE {level} = %s' +
+            (' AND {tree_id} = %s' if tree_id is not None else '') +
+            ' UNION ALL '
+            'SELECT tp.{ancestor}, node.{pk}, tp.{path_len} + 1' +
+            node_tree_id + ' FROM {node} node '
+            'INNER JOIN {tp} tp ON tp.{descendant} = node.{parent} '
+            'WHERE node.{level} = %s' +
+            (' AND node.{tree_id} = %s' if tree_id is not None else ''),
+            [level, tree_id, level, tree_id] if tree_id is not None
+            else [level, level])
+
+    def delete_paths(self, pks, using):
+        self.model._tpm.objects.using(using).filter(
+            descendant_id__in=pks).delete()
+
+    def delete_marked_paths(self, using):
+        self.model._tpm.objects.using(using).filter(
+            descendant__level=-1).delete()
+
+    def check_paths(self):
+        """
+        Rows of every node are compared with rows of its parent only, which
+        covers the whole table by induction from roots: a node needs its self
+        row and a row from every ancestor of its parent, one longer.
+        """
+        fetch = self.model._fetch_sql
+        missing = fetch(
+            'SELECT {pk}, {pk} FROM {node} WHERE NOT EXISTS ('
+            'SELECT 1 FROM {tp} own WHERE own.{ancestor} = {node}.{pk} '
+            'AND own.{descendant} = {node}.{pk}) '
+            'UNION ALL '
+            'SELECT tp.{ancestor}, node.{pk} FROM {node} node '
+            'INNER JOIN {tp} tp ON tp.{descendant} = node.{parent} '
+            'WHERE NOT EXISTS ('
+            'SELECT 1 FROM {tp} own WHERE own.{ancestor} = tp.{ancestor} '
+            'AND own.{descendant} = node.{pk})')
+        inherited = 'SELECT own.{ancestor}, own.{descendant} FROM {tp} own ' \
+                    'INNER JOIN {node} node ' \
+                    'ON node.{pk} = own.{descendant} ' \
+                    'LEFT OUTER JOIN {tp} tp ' \
+                    'ON tp.{descendant} = node.{parent} ' \
+                    'AND tp.{ancestor} = own.{ancestor} ' \
+                    'WHERE own.{ancestor} <> own.{descendant} AND '
+        extra = fetch(inherited + 'tp.{ancestor} IS NULL')
+        path_len = fetch(
+            inherited + 'tp.{path_len} + 1 <> own.{path_len} '
+            'UNION ALL '
+            'SELECT {ancestor}, {descendant} FROM {tp} '
+            'WHERE {ancestor} = {descendant} AND {path_len} <> 0')
+        report = {'missing': missing, 'extra': extra, 'path_len': path_len}
+        if self.model._tree_id:
+            # rows carry tree_id of their descendant
+            report['path_tree_id'] = fetch(
+                'SELECT own.{ancestor}, own.{descendant} FROM {tp} own '
+                'INNER JOIN {node} node ON node.{pk} = own.{descendant} '
+                'WHERE own.{tree_id} IS NULL '
+                'OR own.{tree_id} <> node.{tree_id}')
+        return report
+
+
+class AdjacencyListStrategy(TreeStrategy):
+    """
+    Only the parent column is stored, subtrees and ancestor chains are walked
+    with WITH RECURSIVE queries (SQLite >= 3.8.3, PostgreSQL). No extra
+    table and cheap moves, for the price of recursive reads.
+    """
+    descendant_count_sql = \
+        'WITH RECURSIVE ctt_subtree(id) AS (SELECT {node}.{pk} ' \
+        'UNION ALL SELECT ctt_node.{pk} FROM {node} ctt_node ' \
+        'INNER JOIN ctt_subtree ON ctt_node.{parent} = ctt_subtree.id) ' \
+        'SELECT COUNT(*) - 1 FROM ctt_subtree'
+
+    _subtree_sql = \
+        'WITH RECURSIVE ctt_subtree(id, depth) AS (' \
+        'SELECT ctt_node.{pk}, 0 FROM {node} ctt_node ' \
+        'WHERE ctt_node.{pk} IN (%s) ' \
+        'UNION ALL SELECT ctt_node.{pk}, ctt_subtree.depth + 1 ' \
+        'FROM {node} ctt_node ' \
+        'INNER JOIN ctt_subtree ON ctt_node.{parent} = ctt_subtree.id%s' \
+        ') SELECT id FROM ctt_subtree%s'
+    _ancestors_sql = \
+        'WITH RECURSIVE ctt_path(id, parent_id, depth) AS (' \
+        'SELECT ctt_node.{pk}, ctt_node.{parent}, 0 FROM {node} ctt_node ' \
+        'WHERE ctt_node.{pk} IN (%s) ' \
+        'UNION ALL SELECT ctt_node.{pk}, ctt_node.{parent}, ' \
+        'ctt_path.depth + 1 FROM {node} ctt_node ' \
+        'INNER JOIN ctt_path ON ctt_node.{pk} = ctt_path.parent_id' \
+        ') SELECT id FROM ctt_path%s'
+    _subtree_by_root_sql = \
+        'WITH RECURSIVE ctt_subtree(origin, id, depth) AS (' \
+        'SELECT ctt_node.{pk}, ctt_node.{pk}, 0 FROM {node} ctt_node ' \
+        'WHERE ctt_node.{pk} IN (%s) ' \
+        'UNION ALL SELECT ctt_subtree.origin, ctt_node.{pk}, ' \
+        'ctt_subtree.depth + 1 FROM {node} ctt_node ' \
+        'INNER JOIN ctt_subtree ON ctt_node.{parent} = ctt_subtree.id%s' \
+        ') SELECT {node}.*, ctt_subtree.origin AS ctt_root_id FROM {node} ' \
+        'INNER JOIN ctt_subtree ON {node}.{pk} = ctt_subtree.id ' \
+        'WHERE ctt_subtree.depth >= %d%s ORDER BY ctt_subtree.depth, %s'
+
+    def format_sql(self, sql, connection):
+        if connection.vendor == 'sqlite':
+            from django.db.backends.sqlite3.base import Database
+            supported = Database.sqlite_version_info >= (3, 8, 3)
+        else:
+            supported = connection.vendor == 'postgresql'
+        if not supported:
+            raise NotSupportedError(
+                _('Adjacency list strategy needs WITH RECURSIVE support.'))
+        return super(AdjacencyListStrategy, self).format_sql(sql, connection)
+
+    def _in_sql(self, sql, ids, using):
+        """
+        {node}.{pk} IN (sql) with ids placed in the first %s of sql.
+        """
+        ids_sql, params = _ids_sql(ids, using)
+        sql = self.format_sql(sql, connections[using]).split('%s', 1)
+        return self.format_sql('{node}.{pk} IN (', connections[using]) + \
+            sql[0] + ids_sql + sql[1] + ')', list(params)
+
+    def _subtree(self, roots, using, include_self=True, max_depth=None,
+                 min_depth=None):
+        if min_depth is None:
+            min_depth = 0 if include_self else 1
+        return self._in_sql(
+            self._subtree_sql % (
+                '%s',
+                ' WHERE ctt_subtree.depth < %d' % max_depth
+                if max_depth is not None else '',
+                ' WHERE depth >= %d' % min_depth if min_depth > 0 else ''),
+            roots, using)
+
+    def filter_descendants(self, qs, roots, include_self=False,
+                           max_depth=None, min_depth=None):
+        sql, params = self._subtree(roots, qs.db, include_self, max_depth,
+                                    min_depth)
+        return qs.extra(where=[sql], params=params)
+
+    def descendants_by_root(self, qs, roots, min_depth=1, max_depth=None):
+        connection = connections[qs.db]
+        roots_sql, params = _ids_sql(roots, qs.db)
+        nodes_sql, nodes_params = '', []
+        if qs.query.where:
+            nodes_sql, nodes_params = _ids_sql(qs.values('pk'), qs.db)
+            nodes_sql = ' AND {node}.{pk} IN (%s)' % nodes_sql
+        order = ', '.join('{node}.{%s}' % name
+                          for name in self.model._sort_key_fields)
+        sql = self.format_sql(self._subtree_by_root_sql % (
+            '%s',
+            ' WHERE ctt_subtree.depth < %d' % max_depth
+            if max_depth is not None else '',
+            min_depth, '%s', order), connection).split('%s', 2)
+        sql = sql[0] + roots_sql + sql[1] + \
+            self.format_sql(nodes_sql, connection) + sql[2]
+        nodes = self.model._cls.objects.db_manager(qs.db).raw(
+            sql, list(params) + list(nodes_params))
+        return [(node.ctt_root_id, node) for node in nodes]
+
+    def filter_ancestors(self, qs, nodes, include_self=False):
+        sql, params = self._in_sql(
+            self._ancestors_sql % (
+                '%s', '' if include_self else ' WHERE depth > 0'),
+            nodes, qs.db)
+        return qs.extra(where=[sql], params=params)
+
+    def prefetch_ancestors(self, instances):
+        model = self.model._cls
+        using = router.db_for_read(model)
+        pks = [instance.pk for instance in instances]
+        sql = self.format_sql(
+            'WITH RECURSIVE ctt_path(origin, id, depth) AS ('
+            'SELECT {pk}, {parent}, 1 FROM {node} '
+            'WHERE {parent} IS NOT NULL AND {pk} IN (' +
+            ', '.join(['%s'] * len(pks)) + ') '
+            'UNION ALL SELECT ctt_path.origin, ctt_node.{parent}, '
+            'ctt_path.depth + 1 FROM {node} ctt_node '
+            'INNER JOIN ctt_path ON ctt_node.{pk} = ctt_path.id '
+            'WHERE ctt_node.{parent} IS NOT NULL'
+            ') SELECT {node}.*, ctt_path.origin AS ctt_ancestor_of '
+            'FROM {node} INNER JOIN ctt_path ON {node}.{pk} = ctt_path.id '
+            'ORDER BY ctt_path.depth DESC', connections[using])
+        ancestors = list(model.objects.db_manager(using).raw(sql, pks))
+        for ancestor in ancestors:
+            ancestor._ancestor_of = ancestor.ctt_ancestor_of
+        return ancestors
+
+    def move_subtree(self, node, target_id, old_parent_id):
+        subtree = self.filter_descendants(
+            self.model._cls.objects.db_manager(
+                router.db_for_write(self.model._cls)).all(),
+            [node.pk], include_self=True)
+        self._update_subtree_levels(node, subtree)
+
+    def _update_subtree_levels(self, node, subtree):
+        """
+        Shifts level of descendants of a moved node by the change of its
+        level (UPDATE ... SET level = level + delta), subtree is a queryset
+        of the node with its descendants. Nothing is written when the level
+        has not changed.
+        """
+        # stored levels of children are not updated yet, the level loaded
+        # with the node may be stale
+        levels = self.model._cls.objects.filter(parent_id=node.pk). \
+            values_list('level', flat=True)[:1]
+        if not levels:
+            return
+        old_level = levels[0] - 1
+        if node.level != old_level:
+            subtree.exclude(pk=node.pk).update(
+                level=F('level') + (node.level - old_level))
+
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+#vim: set ts=4 sw=4 et fdm=marker : */
+
+
+def chunked(items, size=500):
+    """
+    Splits items into lists of at most size elements, keeps IN (...) clauses
+    below backend parameter limits (sqlite allows 999).
+    """
+    items = list(items)
+    for start in xrange(0, len(items), size):
+        yield items[start:start + size]
+
+
+def cached_qs(qs, objs):
+    """
+    Makes qs evaluate to objs without querying the database, the same way
+    prefetch_related fills querysets. Chained calls (filter() etc.) still
+    go to the database.
+    """
+    qs._result_cache = list(objs)
+    qs._prefetch_done = True
+    return qs
+
+
+def cache_tree_children(nodes):
+    """
+    Assembles nodes into trees in O(n): every node gets a list of its
+    children from nodes as _cached_children, in the order of nodes.
+    Returns top nodes, i.e. those whose parent is not in nodes.
+    """
+    nodes = list(nodes)
+    by_pk = {}
+    for node in nodes:
+        node._cached_children = []
+        by_pk[node.pk] = node
+    top_nodes = []
+    for node in nodes:
+        parent = by_pk.get(node.parent_id)
+        if parent is None:
+            top_nodes.append(node)
+        else:
+            parent._cached_children.append(node)
+    return top_nodes
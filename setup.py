@@ -3,7 +3,8 @@ from distutils.core import setup
 setup(
     name='django-ctt',
     version='0.1',
-    packages=['tests', 'tests.testapp', 'ctt'],
+    packages=['tests', 'tests.testapp', 'ctt', 'ctt.management',
+              'ctt.management.commands'],
     url='http://www.hiddendata.co/',
     license='HDL',
     author='Hiddendata',
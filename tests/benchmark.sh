@@ -0,0 +1,11 @@
+#!/bin/sh
+export PYTHONPATH="./"
+export DJANGO_SETTINGS_MODULE="${DJANGO_SETTINGS_MODULE:-settings}"
+
+if [ `which django-admin.py` ] ; then
+	export DJANGO_ADMIN=django-admin.py
+else
+	export DJANGO_ADMIN=django-admin
+fi
+
+$DJANGO_ADMIN ctt_benchmark --settings=$DJANGO_SETTINGS_MODULE --pythonpath="../" "$@"
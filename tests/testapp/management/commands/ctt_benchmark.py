@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#vim: set ts=4 sw=4 et fdm=marker : */
+"""
+Benchmark of tree operations on generated tree shapes.
+
+    cd tests
+    django-admin.py ctt_benchmark --settings=settings --pythonpath=../ \
+        --sizes=1000,100000,1000000 --output=results.jsonl
+
+Results are JSON lines, one per (model, shape, size, operation), with wall
+time, query count and rows written. Use --settings=settings_postgres to run
+against a local PostgreSQL.
+"""
+import json
+import random
+import sys
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import get_model
+from ctt.instrumentation import OperationMeter, counting_cursors
+from ctt.utils import chunked
+
+
+def chain_shape(size, rng, depth):
+    """
+    Chains of depth nodes (the last one may be shorter), closure rows of a
+    chain grow with depth squared.
+    """
+    return [None if i % depth == 0 else i - 1 for i in xrange(size)]
+
+
+def fan_shape(size, rng, depth):
+    """
+    One root with all other nodes as its children.
+    """
+    return [None] + [0] * (size - 1)
+
+
+def kary_shape(size, rng, depth, k=4):
+    """
+    Balanced k-ary tree.
+    """
+    return [None] + [(i - 1) // k for i in xrange(1, size)]
+
+
+def random_shape(size, rng, depth):
+    """
+    Real-world-like forest: a root per thousand nodes, new nodes attach
+    mostly near the top, giving wide shallow trees with some deep branches.
+    """
+    parents = []
+    for i in xrange(size):
+        if i == 0 or rng.random() < 0.001:
+            parents.append(None)
+        else:
+            parents.append(int(i * rng.random() ** 2))
+    return parents
+
+
+SHAPES = {
+    'chain': chain_shape,
+    'fan': fan_shape,
+    'kary': kary_shape,
+    'random': random_shape,
+}
+
+OPERATIONS = ('insert', 'bulk_load', 'rebuild', 'get_descendants',
+              'get_children', 'get_ancestors', 'siblings', 'siblings_batch',
+              'move_to', 'ordering', 'delete')
+
+
+class Meter(OperationMeter):
+    """
+    Accumulates wall time, queries and rows written of the with blocks.
+    """
+    def __init__(self, model):
+        super(Meter, self).__init__(model, None, None, connection)
+        self.seconds = 0.0
+        self.calls = 0
+
+    def __enter__(self):
+        # statements are not logged to connection.queries even with DEBUG
+        self.use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = False
+        self.counting = counting_cursors(connection, self)
+        self.counting.__enter__()
+        self.start = time.time()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds += time.time() - self.start
+        self.calls += 1
+        self.counting.__exit__(exc_type, exc_value, traceback)
+        connection.use_debug_cursor = self.use_debug_cursor
+
+
+class Command(BaseCommand):
+    help = 'Times tree operations of testapp models on generated trees ' \
+           'and writes results as JSON lines.'
+    option_list = BaseCommand.option_list + (
+        make_option('--models', default='Node,NodeOrderable',
+                    help='Comma separated testapp models.'),
+        make_option('--shapes', default=','.join(sorted(SHAPES)),
+                    help='Comma separated tree shapes: %s.' %
+                         ', '.join(sorted(SHAPES))),
+        make_option('--sizes', default='1000,10000',
+                    help='Comma separated numbers of nodes.'),
+        make_option('--operations', default=','.join(OPERATIONS),
+                    help='Comma separated operations: %s.' %
+                         ', '.join(OPERATIONS)),
+        make_option('--samples', type='int', default=100,
+                    help='Nodes used by per-node operations.'),
+        make_option('--insert-limit', type='int', default=1000,
+                    help='Nodes inserted one by one by the insert '
+                         'operation.'),
+        make_option('--chain-depth', type='int', default=1000,
+                    help='Depth of chains of the chain shape.'),
+        make_option('--batch-size', type='int', default=None,
+                    help='batch_size of bulk_create_tree().'),
+        make_option('--seed', type='int', default=0),
+        make_option('--label', default='',
+                    help='Release or branch name stored in results.'),
+        make_option('--output', default=None,
+                    help='Results file, stdout by default.'),
+        make_option('--in-place', action='store_true', default=False,
+                    help='Use the configured database (it should have no '
+                         'nodes) instead of a new test database.'),
+    )
+
+    def handle(self, **options):
+        models = [self._get_model(name)
+                  for name in options['models'].split(',')]
+        shapes = options['shapes'].split(',')
+        for shape in shapes:
+            if shape not in SHAPES:
+                raise CommandError('Unknown shape "%s".' % shape)
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        operations = options['operations'].split(',')
+        for operation in operations:
+            if operation not in OPERATIONS:
+                raise CommandError('Unknown operation "%s".' % operation)
+        self.options = options
+        verbosity = int(options.get('verbosity', 1))
+
+        output = open(options['output'], 'w') if options['output'] \
+            else self.stdout
+        old_name = None
+        if not options['in_place']:
+            old_name = connection.settings_dict['NAME']
+            connection.creation.create_test_db(verbosity=0)
+        try:
+            for model in models:
+                for shape in shapes:
+                    for size in sizes:
+                        if verbosity > 1:
+                            sys.stderr.write('%s %s %d\n' % (
+                                model.__name__, shape, size))
+                        for result in self.run(model, shape, size,
+                                               operations):
+                            output.write(json.dumps(result, sort_keys=True) +
+                                         '\n')
+        finally:
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+            if options['output']:
+                output.close()
+
+    def _get_model(self, name):
+        model = get_model('testapp', name)
+        if model is None or getattr(model, '_strategy', None) is None:
+            raise CommandError('"%s" is not a testapp tree model.' % name)
+        return model
+
+    def run(self, model, shape, size, operations):
+        """
+        Builds the tree and runs operations on it, yields result dicts.
+        """
+        rng = random.Random(self.options['seed'])
+        parents = SHAPES[shape](size, rng, self.options['chain_depth'])
+        base = {
+            'label': self.options['label'],
+            'vendor': connection.vendor,
+            'model': model.__name__,
+            'shape': shape,
+            'size': size,
+        }
+
+        def result(operation, meter):
+            return dict(base, operation=operation, count=meter.calls,
+                        seconds=round(meter.seconds, 6),
+                        queries=meter.queries,
+                        rows_written=meter.rows_written)
+
+        if 'insert' in operations:
+            meter = Meter(model)
+            nodes = []
+            for i, parent in enumerate(parents[:self.options['insert_limit']]):
+                with meter:
+                    nodes.append(model.objects.create(
+                        name=str(i),
+                        parent=None if parent is None else nodes[parent]))
+            yield result('insert', meter)
+            model.objects.roots().delete_subtrees()
+
+        nodes = [model(name=str(i)) for i in xrange(size)]
+        for node, parent in zip(nodes, parents):
+            if parent is not None:
+                node.parent = nodes[parent]
+        meter = Meter(model)
+        with meter:
+            model.objects.bulk_create_tree(
+                nodes, batch_size=self.options['batch_size'])
+        if 'bulk_load' in operations:
+            yield result('bulk_load', meter)
+        del nodes
+
+        if 'rebuild' in operations:
+            meter = Meter(model)
+            with meter:
+                model._rebuild_tree()
+            yield result('rebuild', meter)
+
+        pks = list(model.objects.values_list('pk', flat=True))
+        sample = rng.sample(pks, min(self.options['samples'], len(pks)))
+        nodes = []
+        for chunk in chunked(sample):
+            nodes.extend(model.objects.filter(pk__in=chunk))
+
+        for operation, call in (
+                ('get_descendants', lambda node: list(node.get_descendants())),
+                ('get_children', lambda node: list(node.get_children())),
+                ('get_ancestors', lambda node: list(node.get_ancestors())),
+                ('siblings', lambda node: (node.get_next_sibling(),
+                                           node.get_previous_sibling()))):
+            if operation in operations:
+                meter = Meter(model)
+                for node in nodes:
+                    with meter:
+                        call(node)
+                yield result(operation, meter)
+
+        if 'siblings_batch' in operations:
+            meter = Meter(model)
+            with meter:
+                model.get_next_siblings(nodes)
+                model.get_previous_siblings(nodes)
+            yield result('siblings_batch', meter)
+
+        if 'ordering' in operations and hasattr(model, 'move_before'):
+            meter = Meter(model)
+            for node in nodes:
+                node = model.objects.get(pk=node.pk)
+                sibling = node.get_previous_sibling()
+                if sibling is not None:
+                    with meter:
+                        node.move_before(sibling)
+            yield result('ordering', meter)
+
+        if 'move_to' in operations:
+            meter = Meter(model)
+            for node in nodes:
+                node = model.objects.get(pk=node.pk)
+                target = model.objects.get(pk=rng.choice(pks))
+                if target.pk == node.pk or node.is_ancestor_of(target):
+                    continue
+                with meter:
+                    node.move_to(target)
+            yield result('move_to', meter)
+
+        meter = Meter(model)
+        with meter:
+            model.objects.roots().delete_subtrees()
+        if 'delete' in operations:
+            yield result('delete', meter)
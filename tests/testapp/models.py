@@ -4,6 +4,7 @@
 from django.db import models
 import ctt
 from ctt.models import CTTModel, CTTOrderableModel
+from ctt.strategies import AdjacencyListStrategy
 
 class Node(CTTModel):
     name = models.CharField(max_length=255)
@@ -17,3 +18,75 @@ class NodeOrderable(CTTOrderableModel):
 
 
 ctt.register(NodeOrderable)
+
+
+class NodeCounted(CTTModel):
+    name = models.CharField(max_length=255)
+
+    class CTTMeta:
+        cache_counts = True
+
+
+ctt.register(NodeCounted)
+
+
+class NodeTree(CTTModel):
+    name = models.CharField(max_length=255)
+
+    class CTTMeta:
+        tree_id = True
+
+
+ctt.register(NodeTree)
+
+
+class NodeSorted(CTTOrderableModel):
+    name = models.CharField(max_length=255)
+
+    class CTTMeta:
+        sort_key = True
+        # 64 levels, moves in tests go 41 levels deep
+        sort_key_length = 1024
+
+
+ctt.register(NodeSorted)
+
+
+class NodeSortedShallow(CTTOrderableModel):
+    name = models.CharField(max_length=255)
+
+    class CTTMeta:
+        sort_key = True
+        # 3 levels
+        sort_key_length = 48
+
+
+ctt.register(NodeSortedShallow)
+
+
+class NodePlainManager(CTTModel):
+    name = models.CharField(max_length=255)
+
+    objects = models.Manager()
+
+
+ctt.register(NodePlainManager)
+
+
+class NodeTreeLink(models.Model):
+    node = models.ForeignKey(NodeTree)
+
+
+class NodeAdjacency(CTTModel):
+    name = models.CharField(max_length=255)
+
+
+ctt.register(NodeAdjacency, strategy=AdjacencyListStrategy)
+
+
+class NodeCompact(CTTModel):
+    name = models.CharField(max_length=255)
+
+
+ctt.register(NodeCompact, path_indexes='descendants',
+             path_len_field=models.PositiveSmallIntegerField)
@@ -2,8 +2,25 @@
 #-*- coding: utf-8 -*-
 #vim: set ts=4 sw=4 et fdm=marker : */
 
+from StringIO import StringIO
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, models, router
+from django.db.utils import OperationalError
+from django.db.models import signals
 from django.test import TestCase
-from testapp.models import Node, NodeOrderable
+from django.test.utils import CaptureQueriesContext, override_settings
+import json
+import logging
+from django.core.exceptions import ImproperlyConfigured
+import ctt
+from ctt.models import CTTModel
+from ctt.instrumentation import log_slow_operation
+from ctt.signals import tree_operation
+from ctt.strategies import AdjacencyListStrategy
+from testapp.models import Node, NodeOrderable, NodeCounted, NodeTree, \
+    NodeSorted, NodePlainManager, NodeTreeLink, NodeAdjacency, NodeCompact, \
+    NodeSortedShallow
 
 
 class CTTDummyTest(TestCase):
@@ -202,6 +219,24 @@ class CTTDummyTest(TestCase):
         else:
             self.assertNotEqual(self.n3, self.n5.get_previous_sibling())
 
+    def test_get_sibling_keyset(self):
+        n7 = Node.objects.create(name='7', parent=self.n2)
+        self.assertEqual(self.n3.get_next_sibling(), self.n4)
+        self.assertEqual(self.n4.get_next_sibling(), n7)
+        self.assertEqual(n7.get_next_sibling(), None)
+        self.assertEqual(n7.get_previous_sibling(), self.n4)
+        self.assertEqual(self.n3.get_previous_sibling(), None)
+        self.assertEqual(self.n3.get_next_sibling(name='7'), n7)
+        self.assertEqual(self.n1.get_next_sibling(), None)
+
+    def test_get_next_siblings(self):
+        with self.assertNumQueries(2):
+            links = Node.get_next_siblings([self.n1, self.n3, self.n4.pk])
+        self.assertEqual(
+            links, {self.n1.pk: None, self.n3.pk: self.n4, self.n4.pk: None})
+        links = Node.get_previous_siblings([self.n4, self.n5])
+        self.assertEqual(links, {self.n4.pk: self.n3, self.n5.pk: self.n2})
+
     def test_get_leafnodes(self):
         self.assertTrue(self.n3 in self.n1.get_leafnodes())
         self.assertTrue(self.n4 in self.n1.get_leafnodes())
@@ -306,6 +341,22 @@ class CTTDummyTest(TestCase):
         self.assertFalse(self.n2.is_ancestor_of(self.n5, include_self=True))
         self.assertFalse(self.n4.is_ancestor_of(self.n5, include_self=True))
 
+    def test_relationship_queries(self):
+        with self.assertNumQueries(1):
+            self.assertTrue(self.n1.is_ancestor_of(self.n3))
+        with self.assertNumQueries(1):
+            self.assertFalse(self.n5.is_descendant_of(self.n2))
+
+    def test_filter_descendants(self):
+        candidates = [self.n1, self.n3, self.n5, self.n6, self.n2.pk]
+        with self.assertNumQueries(1):
+            self.assertEqual(self.n2.filter_descendants(candidates),
+                             [self.n3])
+        self.assertEqual(
+            self.n2.filter_descendants(candidates, include_self=True),
+            [self.n3, self.n2.pk])
+        self.assertEqual(self.n1.filter_descendants([]), [])
+
     def test_delete_leaf(self):
         self.assertEqual(Node._tpm.objects.count(), 12)
         self.n5.delete()
@@ -485,6 +536,272 @@ class CTTDummyTest(TestCase):
         self.assertFalse(self.n4 in self.n4.get_ancestors())
         self.assertFalse(self.n6 in self.n4.get_ancestors())
 
+    def test_save_without_move_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.n3.name = '3a'
+            self.n3.save()
+        self.assertEqual(len(queries), 1)
+        self.assertTrue('UPDATE' in queries[0]['sql'])
+
+        n4 = Node.objects.get(pk=self.n4.pk)
+        with CaptureQueriesContext(connection) as queries:
+            n4.name = '4a'
+            n4.save()
+        self.assertEqual(len(queries), 1)
+        self.assertTrue('UPDATE' in queries[0]['sql'])
+
+    def test_save_deferred_parent(self):
+        n3 = Node.objects.only('name').get(pk=self.n3.pk)
+        n3.name = '3a'
+        n3.save()
+        self.assertEqual(Node.objects.get(pk=self.n3.pk).level, 2)
+        self.assertEqual(Node._tpm.objects.count(), 12)
+
+    def test_move_parent_id(self):
+        n3 = Node.objects.get(pk=self.n3.pk)
+        n3.parent_id = self.n5.pk
+        n3.save()
+        self.assertEqual(n3.level, 2)
+        self.assertEqual(list(n3.get_ancestors()), [self.n1, self.n5])
+
+    def test_get_tree(self):
+        with self.assertNumQueries(1):
+            root = self.n1.get_tree()
+        self.assertTrue(root is self.n1)
+        with self.assertNumQueries(0):
+            children = dict((n.name, n) for n in root.get_children())
+            self.assertEqual(sorted(children), ['2', '5'])
+            n2 = children['2']
+            self.assertEqual(
+                sorted(n.name for n in n2.get_children()), ['3', '4'])
+            self.assertEqual(root.get_descendant_count(), 4)
+            self.assertEqual(len(n2.get_descendants(include_self=True)), 3)
+            self.assertFalse(n2.is_leaf_node())
+            self.assertTrue(children['5'].is_leaf_node())
+        # filtering still works, against the database
+        self.assertEqual(list(root.get_children(name='5')), [self.n5])
+
+    def test_get_tree_max_depth(self):
+        with self.assertNumQueries(1):
+            root = self.n1.get_tree(max_depth=1)
+        with self.assertNumQueries(0):
+            children = dict((n.name, n) for n in root.get_children())
+        with self.assertNumQueries(1):
+            self.assertEqual(len(children['2'].get_children()), 2)
+        with self.assertNumQueries(1):
+            self.assertEqual(root.get_descendant_count(), 4)
+
+    def test_depth_one_uses_parent_column(self):
+        n2 = Node.objects.get(pk=self.n2.pk)
+        n3 = Node.objects.get(pk=self.n3.pk)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(sorted(n.name for n in n2.get_children()),
+                             ['3', '4'])
+            self.assertEqual(list(n3.get_siblings()), [self.n4])
+            self.assertEqual(
+                sorted(n.name for n in n2.get_descendants(include_self=True,
+                                                          max_depth=1)),
+                ['2', '3', '4'])
+            self.assertEqual(list(n2.get_descendants(max_depth=0)), [])
+            self.assertEqual(len(n2.get_tree(max_depth=1).get_children()), 2)
+            self.assertFalse(n2.is_leaf_node())
+            self.assertEqual(sorted(n.name for n in Node.objects.leaves()),
+                             ['3', '4', '5', '6'])
+            self.assertEqual(
+                dict((n.name, (n.child_count, n.is_leaf)) for n in
+                     Node.objects.with_child_count().with_is_leaf().filter(
+                         pk__in=[self.n2.pk, self.n3.pk])),
+                {'2': (2, 0), '3': (0, 1)})
+        # max_depth=0 without include_self needs no query
+        self.assertEqual(len(queries), 6)
+        for query in queries:
+            self.assertNotIn(Node._tpm._meta.db_table, query['sql'])
+        # deeper levels still go through the closure table
+        self.assertIn(Node._tpm._meta.db_table,
+                      str(n2.get_descendants(max_depth=2).query))
+
+    def test_get_descendants_depth(self):
+        names = lambda nodes: sorted(n.name for n in nodes)
+        self.assertEqual(names(self.n1.get_descendants(max_depth=1)),
+                         ['2', '5'])
+        self.assertEqual(names(self.n1.get_descendants(min_depth=2)),
+                         ['3', '4'])
+        self.assertEqual(
+            names(self.n1.get_descendants(min_depth=0, max_depth=1)),
+            ['1', '2', '5'])
+        root = self.n1.get_tree()
+        with self.assertNumQueries(0):
+            self.assertEqual(names(root.get_descendants(min_depth=2)),
+                             ['3', '4'])
+            self.assertEqual(
+                names(root.get_descendants(include_self=True, max_depth=1)),
+                ['1', '2', '5'])
+
+    def test_descendants_by_parent(self):
+        with self.assertNumQueries(1):
+            grouped = Node.objects.descendants_by_parent(
+                [self.n1, self.n2.pk, self.n6])
+        self.assertEqual(
+            dict((pk, [n.name for n in nodes])
+                 for pk, nodes in grouped.items()),
+            {self.n1.pk: ['2', '5', '3', '4'], self.n2.pk: ['3', '4'],
+             self.n6.pk: []})
+        grouped = Node.objects.descendants_by_parent([self.n1, self.n2],
+                                                     max_depth=1)
+        self.assertEqual([n.name for n in grouped[self.n1.pk]], ['2', '5'])
+        grouped = Node.objects.exclude(name='4').descendants_by_parent(
+            [self.n1], min_depth=0)
+        self.assertEqual([n.name for n in grouped[self.n1.pk]],
+                         ['1', '2', '5', '3'])
+
+    def test_with_ancestors(self):
+        with self.assertNumQueries(2):
+            nodes = dict((n.name, n) for n in Node.objects.with_ancestors())
+        with self.assertNumQueries(0):
+            self.assertEqual(list(nodes['3'].get_ancestors()),
+                             [self.n1, self.n2])
+            self.assertEqual(
+                list(nodes['3'].get_ancestors(ascending=True,
+                                              include_self=True)),
+                [self.n3, self.n2, self.n1])
+            self.assertEqual(list(nodes['1'].get_ancestors()), [])
+            self.assertEqual(list(nodes['5'].ancestors), [self.n1])
+
+    def test_prefetch_ancestors(self):
+        with self.assertNumQueries(2):
+            nodes = list(Node.objects.filter(level=2).order_by('name').
+                         prefetch_related('ancestors'))
+        with self.assertNumQueries(0):
+            self.assertEqual([list(n.get_ancestors()) for n in nodes],
+                             [[self.n1, self.n2], [self.n1, self.n2]])
+
+    def test_count_annotations(self):
+        with self.assertNumQueries(1):
+            nodes = dict(
+                (n.name, n) for n in Node.objects.with_descendant_count().
+                with_child_count().with_is_leaf())
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                dict((k, n.get_descendant_count()) for k, n in nodes.items()),
+                {'1': 4, '2': 2, '3': 0, '4': 0, '5': 0, '6': 0})
+            self.assertEqual(
+                dict((k, n.child_count) for k, n in nodes.items()),
+                {'1': 2, '2': 2, '3': 0, '4': 0, '5': 0, '6': 0})
+            self.assertEqual(
+                sorted(k for k, n in nodes.items() if n.is_leaf_node()),
+                ['3', '4', '5', '6'])
+
+    def test_count_annotations_filtered(self):
+        nodes = self.n1.get_descendants().filter(level=1). \
+            with_descendant_count()
+        self.assertEqual(
+            sorted((n.name, n.descendant_count) for n in nodes),
+            [('2', 2), ('5', 0)])
+
+    def names(self, nodes):
+        return sorted(node.name for node in nodes)
+
+    def test_queryset_descendants_of(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                self.names(Node.objects.descendants_of([self.n2, self.n5])),
+                ['3', '4'])
+        self.assertEqual(
+            self.names(Node.objects.descendants_of(
+                Node.objects.filter(name__in=['2', '6']), include_self=True)),
+            ['2', '3', '4', '6'])
+        self.assertEqual(
+            self.names(Node.objects.filter(name='4').descendants_of(self.n1)),
+            ['4'])
+
+    def test_queryset_ancestors_of(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                self.names(Node.objects.ancestors_of(
+                    Node.objects.filter(name__in=['3', '4', '5']))),
+                ['1', '2'])
+        self.assertEqual(
+            self.names(Node.objects.ancestors_of([self.n3.pk],
+                                                 include_self=True)),
+            ['1', '2', '3'])
+
+    def test_queryset_children_of(self):
+        self.assertEqual(
+            self.names(Node.objects.children_of(
+                Node.objects.filter(level=0))),
+            ['2', '5'])
+
+    def test_queryset_roots_leaves(self):
+        self.assertEqual(self.names(Node.objects.roots()), ['1', '6'])
+        self.assertEqual(self.names(Node.objects.leaves()),
+                         ['3', '4', '5', '6'])
+        self.assertEqual(
+            self.names(Node.objects.leaves().descendants_of(self.n1)),
+            ['3', '4', '5'])
+        self.assertEqual(self.names(Node.objects.at_depth(1)), ['2', '5'])
+
+    def assertPathsRebuilt(self):
+        paths = sorted(Node._tpm.objects.values_list(
+            'ancestor_id', 'descendant_id', 'path_len'))
+        Node._rebuild_tree()
+        self.assertEqual(paths, sorted(Node._tpm.objects.values_list(
+            'ancestor_id', 'descendant_id', 'path_len')))
+
+    def test_delete_subtree(self):
+        # mark, delete paths, delete nodes, plus the savepoint
+        with self.assertNumQueries(5):
+            self.assertEqual(self.n2.delete_subtree(), 3)
+        self.assertEqual(self.names(Node.objects.all()), ['1', '5', '6'])
+        self.assertEqual(self.names(self.n1.get_descendants()), ['5'])
+        self.assertPathsRebuilt()
+
+    def test_delete_subtrees(self):
+        deleted = Node.objects.filter(name__in=['2', '3', '6']). \
+            delete_subtrees()
+        self.assertEqual(deleted, 4)
+        self.assertEqual(self.names(Node.objects.all()), ['1', '5'])
+        self.assertPathsRebuilt()
+
+    def test_delete_subtrees_using(self):
+        class OtherRouter(object):
+            def db_for_write(self, model, **hints):
+                return 'other'
+        c1 = NodeCounted.objects.create(name='1')
+        c2 = NodeCounted.objects.create(name='2', parent=c1)
+        NodeCounted.objects.create(name='3', parent=c2)
+        routers = router.routers
+        router.routers = [OtherRouter()]
+        try:
+            # raw statements run on the database of the queryset too
+            self.assertEqual(Node.objects.using('default').filter(
+                pk=self.n2.pk).delete_subtrees(), 3)
+            self.assertEqual(NodeCounted.objects.using('default').filter(
+                pk=c2.pk).delete_subtrees(send_signals=True), 2)
+        finally:
+            router.routers = routers
+        self.assertEqual(self.names(Node.objects.all()), ['1', '5', '6'])
+        self.assertEqual(NodeCounted.objects.get(pk=c1.pk).descendant_count,
+                         0)
+
+    def test_delete_subtree_signals(self):
+        sent = []
+
+        def receiver(signal, sender, instance, **kwargs):
+            sent.append((signal is signals.pre_delete, instance.name,
+                         instance.level))
+        signals.pre_delete.connect(receiver, sender=Node)
+        signals.post_delete.connect(receiver, sender=Node)
+        try:
+            self.n1.delete_subtree()
+            self.assertEqual(len(sent), 0)
+            self.n6.delete_subtree(send_signals=True)
+        finally:
+            signals.pre_delete.disconnect(receiver, sender=Node)
+            signals.post_delete.disconnect(receiver, sender=Node)
+        self.assertEqual(sent, [(True, '6', 0), (False, '6', 0)])
+        self.assertEqual(Node.objects.count(), 0)
+        self.assertEqual(Node._tpm.objects.count(), 0)
+
     def test_level(self):
         for node in (self.n1, self.n2, self.n3, self.n4, self.n5, self.n6):
             self.assertEqual(node.level, node.get_level())
@@ -495,6 +812,857 @@ class CTTDummyTest(TestCase):
             self.assertEqual(readnode.level, node.get_level())
 
 
+class CTTMoveQueriesTest(TestCase):
+    def _move_branch(self, size):
+        """
+        Moves a branch of `size` descendants under another root and returns
+        the number of executed queries.
+        """
+        root = Node.objects.create(name='root')
+        target = Node.objects.create(name='target')
+        branch = Node.objects.create(name='branch', parent=root)
+        parent = branch
+        for i in xrange(size):
+            parent = Node.objects.create(name=unicode(i), parent=parent)
+
+        with CaptureQueriesContext(connection) as queries:
+            branch.move_to(target)
+
+        self.assertEqual(parent.get_ancestors().count(), size + 1)
+        self.assertTrue(target in parent.get_ancestors())
+        self.assertFalse(root in parent.get_ancestors())
+        return len(queries)
+
+    def test_move_queries_constant(self):
+        self.assertEqual(self._move_branch(2), self._move_branch(50))
+
+    def test_move_to_root(self):
+        self.n1 = Node.objects.create(name='1')
+        self.n2 = Node.objects.create(name='2', parent=self.n1)
+        self.n3 = Node.objects.create(name='3', parent=self.n2)
+        self.n2.move_to(None)
+        self.assertEqual(self.n2.parent, None)
+        self.assertEqual(list(self.n3.get_ancestors()), [self.n2])
+        self.assertEqual(list(self.n1.get_descendants()), [])
+        self.assertEqual(Node._tpm.objects.count(), 4)
+
+    def _chain(self, model, name, length, parent=None):
+        nodes = []
+        for i in xrange(length):
+            parent = model.objects.create(name='%s%d' % (name, i),
+                                          parent=parent)
+            nodes.append(parent)
+        return nodes
+
+    def test_save_after_ancestor_moved(self):
+        for model in (Node, NodeTree, NodeSorted, NodeCounted):
+            n1 = model.objects.create(name='1')
+            n2 = model.objects.create(name='2', parent=n1)
+            n3 = model.objects.create(name='3', parent=n2)
+            n6 = model.objects.create(name='6')
+            n5 = model.objects.create(name='5', parent=n6)
+            n2.move_to(n5)
+            # n3 still holds the level (tree_id, sort_key) of the old place
+            n3.name = 'x'
+            n3.save()
+            report = model._check_tree()
+            self.assertEqual([name for name, rows in report.items() if rows],
+                             [])
+            self.assertEqual(model.objects.get(pk=n3.pk).name, 'x')
+            self.assertEqual(model.objects.get(pk=n3.pk).level, 3)
+
+    def test_save_stale_instance(self):
+        for model in (Node, NodeTree, NodeSorted):
+            n1 = model.objects.create(name='1')
+            n2 = model.objects.create(name='2', parent=n1)
+            n3 = model.objects.create(name='3', parent=n2)
+            r = model.objects.create(name='r')
+            stale = model.objects.get(pk=n3.pk)
+            model.objects.get(pk=n3.pk).move_to(r)
+            # stale still holds parent 2
+            stale.name = 'x'
+            stale.save()
+            report = model._check_tree()
+            self.assertEqual([name for name, rows in report.items() if rows],
+                             [])
+            node = model.objects.get(pk=n3.pk)
+            self.assertEqual((node.name, node.parent_id, node.level),
+                             ('x', r.pk, 1))
+            self.assertEqual(list(node.get_ancestors()), [r])
+        self.assertEqual(
+            [n.name for n in NodeSorted.objects.get(name='r').get_descendants(
+                include_self=True, ordered=True)], ['r', 'x'])
+
+    def test_move_with_update_fields(self):
+        for model in (Node, NodeTree, NodeSorted, NodeAdjacency):
+            n1 = model.objects.create(name='1')
+            n2 = model.objects.create(name='2', parent=n1)
+            n3 = model.objects.create(name='3', parent=n2)
+            r = model.objects.create(name='r')
+            n3.parent = r
+            n3.name = 'x'
+            n3.save(update_fields=['parent'])
+            report = model._check_tree()
+            self.assertEqual([name for name, rows in report.items() if rows],
+                             [])
+            node = model.objects.get(pk=n3.pk)
+            self.assertEqual((node.name, node.parent_id, node.level),
+                             ('3', r.pk, 1))
+            if hasattr(node, 'tree_id'):
+                self.assertEqual(node.tree_id, r.tree_id)
+
+    def test_move_with_stale_instance(self):
+        for model in (Node, NodeTree, NodeSorted, NodeAdjacency):
+            n1 = model.objects.create(name='1')
+            n2 = model.objects.create(name='2', parent=n1)
+            n3 = model.objects.create(name='3', parent=n2)
+            n6 = model.objects.create(name='6')
+            n7 = model.objects.create(name='7')
+            n1.move_to(n6)
+            # n2 still holds level 1
+            n2.move_to(n7)
+            self.assertEqual(model.objects.get(pk=n3.pk).level, 2)
+            self.assertEqual(model._check_tree()['level'], [])
+
+    def test_move_deep_levels(self):
+        for model in (Node, NodeTree, NodeSorted, NodeAdjacency):
+            branch = self._chain(model, 'b', 30)
+            target = self._chain(model, 't', 12)[-1]
+            # 29 descendants shifted with a single UPDATE
+            branch[1].move_to(target)
+            self.assertEqual(
+                list(model.objects.filter(pk__in=[n.pk for n in branch[1:]]).
+                     order_by('level').values_list('level', flat=True)),
+                range(12, 41))
+            self.assertEqual(model._check_tree()['level'], [])
+            self.assertEqual(
+                list(model.objects.filter(name='b29').get().get_ancestors().
+                     values_list('name', flat=True)),
+                ['t%d' % i for i in xrange(12)] +
+                ['b%d' % i for i in xrange(1, 29)])
+            # moved up again, parent not loaded
+            node = model.objects.get(pk=branch[20].pk)
+            node.parent = None
+            node.save()
+            self.assertEqual(
+                list(model.objects.filter(pk__in=[n.pk for n in branch[20:]]).
+                     order_by('level').values_list('level', flat=True)),
+                range(10))
+            self.assertEqual(model._check_tree()['level'], [])
+
+
+class CTTInsertQueriesTest(TestCase):
+    def _insert_under(self, depth):
+        parent = None
+        for i in xrange(depth):
+            parent = Node.objects.create(name=unicode(i), parent=parent)
+
+        with CaptureQueriesContext(connection) as queries:
+            node = Node.objects.create(name='new', parent=parent)
+
+        self.assertEqual(node.get_ancestors().count(), depth)
+        self.assertEqual(node.tpd.get(ancestor=parent).path_len, 1)
+        return len(queries)
+
+    def test_insert_queries_constant(self):
+        self.assertEqual(self._insert_under(1), self._insert_under(30))
+
+    def test_insert_by_parent_id(self):
+        for model in (Node, NodeTree, NodeSorted, NodeCounted):
+            parent = model.objects.create(name='1')
+            with CaptureQueriesContext(connection) as cached:
+                model.objects.create(name='2', parent=parent)
+            with CaptureQueriesContext(connection) as queries:
+                node = model.objects.create(name='3', parent_id=parent.pk)
+            # the parent is read once, by _set_tree_fields()
+            self.assertEqual(len(queries), len(cached) + 1)
+            self.assertEqual(list(node.get_ancestors()), [parent])
+            self.assertEqual(model.objects.get(pk=node.pk).level, 1)
+
+
+class CTTBulkCreateTreeTest(TestCase):
+    def _paths(self, model):
+        return sorted(model._tpm.objects.values_list(
+            'ancestor__name', 'descendant__name', 'path_len'))
+
+    def test_bulk_create_tree(self):
+        """
+            1
+           / \
+          2   5
+         / \
+        3   4
+        """
+        n1 = Node.objects.create(name='1')
+        n2 = Node(name='2', parent=n1)
+        n3 = Node(name='3', parent=n2)
+        n4 = Node(name='4', parent=n2)
+        n5 = Node(name='5', parent=n1)
+        n6 = Node(name='6')
+        # children before their parents on purpose
+        Node.objects.bulk_create_tree([n3, n4, n6, n5, n2])
+
+        self.assertEqual(
+            dict(Node.objects.values_list('name', 'level')),
+            {'1': 0, '2': 1, '3': 2, '4': 2, '5': 1, '6': 0})
+        paths = self._paths(Node)
+        self.assertEqual(len(paths), 12)
+        Node._rebuild_tree()
+        self.assertEqual(paths, self._paths(Node))
+
+    def test_bulk_create_tree_queries(self):
+        def load(size):
+            root = Node(name='root')
+            nodes = [root]
+            for i in xrange(size):
+                nodes.append(Node(name=unicode(i), parent=root))
+            with CaptureQueriesContext(connection) as queries:
+                Node.objects.bulk_create_tree(nodes)
+            return len(queries)
+
+        self.assertEqual(load(5), load(100))
+        self.assertEqual(Node._tpm.objects.count(), 2 + 2 * 105)
+
+    def test_bulk_create_tree_unsaved_parent(self):
+        orphan = Node(name='orphan', parent=Node(name='unsaved'))
+        self.assertRaises(ValueError, Node.objects.bulk_create_tree, [orphan])
+
+    def test_bulk_create_tree_orderable(self):
+        n1 = NodeOrderable.objects.create(name='1')
+        n2 = NodeOrderable.objects.create(name='2', parent=n1)
+        n3 = NodeOrderable(name='3', parent=n1)
+        n4 = NodeOrderable(name='4', parent=n3)
+        n5 = NodeOrderable(name='5', parent=n3)
+        NodeOrderable.objects.bulk_create_tree([n3, n4, n5])
+
+        self.assertEqual(
+            dict(NodeOrderable.objects.values_list('name', 'order')),
+            {'1': 0, '2': 0, '3': 10, '4': 0, '5': 10})
+        self.assertEqual(n2.get_next_sibling(), n3)
+        # leaves were bulk inserted, so they have no pk to compare by
+        self.assertEqual([n.name for n in n3.get_children()], ['4', '5'])
+
+
+class CTTCountsTest(TestCase):
+    def setUp(self):
+        """
+            1
+           / \
+          2   5
+         / \
+        3   4
+        """
+        self.n1 = NodeCounted.objects.create(name='1')
+        self.n2 = NodeCounted.objects.create(name='2', parent=self.n1)
+        self.n3 = NodeCounted.objects.create(name='3', parent=self.n2)
+        self.n4 = NodeCounted.objects.create(name='4', parent=self.n2)
+        self.n5 = NodeCounted.objects.create(name='5', parent=self.n1)
+        self.n6 = NodeCounted.objects.create(name='6')
+
+    def assertCounts(self, expected):
+        counts = NodeCounted.objects.values_list(
+            'name', 'child_count', 'descendant_count')
+        self.assertEqual(
+            dict((name, (children, descendants))
+                 for name, children, descendants in counts),
+            expected)
+        self.assertEqual(list(NodeCounted._check_counts()), [])
+
+    def test_insert(self):
+        self.assertCounts({'1': (2, 4), '2': (2, 2), '3': (0, 0),
+                           '4': (0, 0), '5': (0, 0), '6': (0, 0)})
+
+    def test_move(self):
+        self.n2.move_to(self.n5)
+        self.assertCounts({'1': (1, 4), '2': (2, 2), '3': (0, 0),
+                           '4': (0, 0), '5': (1, 3), '6': (0, 0)})
+        self.n2.move_to(None)
+        self.assertCounts({'1': (1, 1), '2': (2, 2), '3': (0, 0),
+                           '4': (0, 0), '5': (0, 0), '6': (0, 0)})
+
+    def test_delete(self):
+        self.n2.delete()
+        self.assertCounts({'1': (1, 1), '5': (0, 0), '6': (0, 0)})
+
+    def test_delete_subtree(self):
+        self.n2.delete_subtree()
+        self.assertCounts({'1': (1, 1), '5': (0, 0), '6': (0, 0)})
+        NodeCounted.objects.filter(name__in=['5', '6']).delete_subtrees()
+        self.assertCounts({'1': (0, 0)})
+
+    def test_leaves(self):
+        self.assertEqual(
+            sorted(NodeCounted.objects.leaves().values_list('name',
+                                                            flat=True)),
+            ['3', '4', '5', '6'])
+
+    def test_bulk_create_tree(self):
+        n7 = NodeCounted(name='7', parent=self.n5)
+        n8 = NodeCounted(name='8', parent=n7)
+        n9 = NodeCounted(name='9', parent=self.n6)
+        NodeCounted.objects.bulk_create_tree([n8, n9, n7])
+        self.assertCounts({'1': (2, 6), '2': (2, 2), '3': (0, 0),
+                           '4': (0, 0), '5': (1, 2), '6': (1, 1),
+                           '7': (1, 1), '8': (0, 0), '9': (0, 0)})
+
+    def test_leaf_and_count_from_columns(self):
+        n2 = NodeCounted.objects.get(pk=self.n2.pk)
+        with self.assertNumQueries(0):
+            self.assertFalse(n2.is_leaf_node())
+            self.assertEqual(n2.get_descendant_count(), 2)
+        leaves = NodeCounted.objects.with_is_leaf().filter(level=2)
+        self.assertEqual([bool(n.is_leaf) for n in leaves], [True, True])
+
+    def test_check_and_rebuild_counts(self):
+        NodeCounted.objects.filter(pk=self.n1.pk).update(descendant_count=9)
+        drifted = list(NodeCounted._check_counts())
+        self.assertEqual(drifted, [self.n1])
+        self.assertEqual(drifted[0].actual_descendant_count, 4)
+        NodeCounted._rebuild_tree()
+        self.assertCounts({'1': (2, 4), '2': (2, 2), '3': (0, 0),
+                           '4': (0, 0), '5': (0, 0), '6': (0, 0)})
+
+
+class CTTTreeIdTest(TestCase):
+    def setUp(self):
+        """
+            1         6
+           / \
+          2   5
+         / \
+        3   4
+        """
+        self.n1 = NodeTree.objects.create(name='1')
+        self.n2 = NodeTree.objects.create(name='2', parent=self.n1)
+        self.n3 = NodeTree.objects.create(name='3', parent=self.n2)
+        self.n4 = NodeTree.objects.create(name='4', parent=self.n2)
+        self.n5 = NodeTree.objects.create(name='5', parent=self.n1)
+        self.n6 = NodeTree.objects.create(name='6')
+
+    def assertTrees(self, expected):
+        """
+        expected maps node name to name of its root
+        """
+        names = dict(NodeTree.objects.values_list('pk', 'name'))
+        self.assertEqual(
+            dict((name, names[tree_id]) for name, tree_id in
+                 NodeTree.objects.values_list('name', 'tree_id')),
+            expected)
+        for path in NodeTree._tpm.objects.select_related('descendant'):
+            self.assertEqual(path.tree_id, path.descendant.tree_id)
+
+    def test_insert(self):
+        self.assertTrees({'1': '1', '2': '1', '3': '1', '4': '1', '5': '1',
+                          '6': '6'})
+        self.assertEqual(self.n3.tree_id, self.n1.pk)
+        self.assertEqual(self.n6.tree_id, self.n6.pk)
+
+    def test_insert_under_deferred_parent(self):
+        with NodeTree.tree_updates_deferred():
+            b = NodeTree.objects.create(name='b', parent=self.n6)
+        # tree_id of b was set when deferring ended, not on the instance
+        c = NodeTree.objects.create(name='c', parent=b)
+        self.assertEqual(c.tree_id, self.n6.pk)
+        self.assertTrees({'1': '1', '2': '1', '3': '1', '4': '1', '5': '1',
+                          '6': '6', 'b': '6', 'c': '6'})
+
+    def test_move_within_tree(self):
+        self.n3.move_to(self.n5)
+        self.assertTrees({'1': '1', '2': '1', '3': '1', '4': '1', '5': '1',
+                          '6': '6'})
+        self.assertEqual(NodeTree._check_tree()['path_tree_id'], [])
+        NodeTree._rebuild_tree(tree_id=self.n1.pk)
+        self.assertEqual(
+            sorted(n.name for n in self.n5.get_descendants()), ['3'])
+
+    def test_move_with_stale_instance(self):
+        n2 = NodeTree.objects.get(pk=self.n2.pk)
+        self.n2.move_to(self.n6)
+        # n2 still holds tree_id of 1
+        n2.move_to(self.n5)
+        self.assertTrees({'1': '1', '2': '1', '3': '1', '4': '1', '5': '1',
+                          '6': '6'})
+
+    def test_check_path_tree_id(self):
+        NodeTree._tpm.objects.filter(descendant=self.n4, ancestor=self.n1). \
+            update(tree_id=None)
+        self.assertEqual(NodeTree._check_tree()['path_tree_id'],
+                         [(self.n1.pk, self.n4.pk)])
+        NodeTree._repair_tree()
+        self.assertEqual(NodeTree._check_tree()['path_tree_id'], [])
+
+    def test_get_root(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.n4.get_root(), self.n1)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.n6.get_root(), self.n6)
+
+    def test_move(self):
+        self.n2.move_to(self.n6)
+        self.assertTrees({'1': '1', '2': '6', '3': '6', '4': '6', '5': '1',
+                          '6': '6'})
+        self.n2.move_to(None)
+        self.assertTrees({'1': '1', '2': '2', '3': '2', '4': '2', '5': '1',
+                          '6': '6'})
+        self.assertEqual(NodeTree.objects.get(name='3').get_root(), self.n2)
+
+    def test_in_tree(self):
+        self.assertEqual(
+            sorted(NodeTree.objects.in_tree(self.n4).values_list('name',
+                                                                 flat=True)),
+            ['1', '2', '3', '4', '5'])
+        self.assertEqual(list(NodeTree.objects.in_tree(self.n6.pk)),
+                         [self.n6])
+
+    def test_bulk_create_tree(self):
+        n7 = NodeTree(name='7')
+        n8 = NodeTree(name='8', parent=n7)
+        n9 = NodeTree(name='9', parent=self.n5)
+        n10 = NodeTree(name='10')
+        NodeTree.objects.bulk_create_tree([n7, n8, n9, n10])
+        self.assertEqual(n8.tree_id, n7.pk)
+        self.assertTrees({'1': '1', '2': '1', '3': '1', '4': '1', '5': '1',
+                          '6': '6', '7': '7', '8': '7', '9': '1',
+                          '10': '10'})
+
+    def test_rebuild_tree(self):
+        NodeTree._tpm.objects.all().delete()
+        NodeTree.objects.update(level=0, tree_id=None)
+        NodeTree._rebuild_tree()
+        self.assertTrees({'1': '1', '2': '1', '3': '1', '4': '1', '5': '1',
+                          '6': '6'})
+        self.assertEqual(self.n3.get_ancestors()[0], self.n1)
+        self.assertEqual(NodeTree.objects.get(name='3').level, 2)
+
+    def test_rebuild_one_tree(self):
+        paths = NodeTree._tpm.objects.count()
+        NodeTree._tpm.objects.filter(tree_id=self.n1.pk).delete()
+        NodeTree.objects.filter(tree_id=self.n6.pk).update(level=5)
+        NodeTree._rebuild_tree(tree_id=self.n1.pk)
+        self.assertEqual(NodeTree._tpm.objects.count(), paths)
+        self.assertEqual(NodeTree.objects.get(name='4').level, 2)
+        # other trees are left alone
+        self.assertEqual(NodeTree.objects.get(name='6').level, 5)
+
+    def test_delete_subtree_relations(self):
+        NodeTreeLink.objects.create(node=self.n3)
+        NodeTreeLink.objects.create(node=self.n5)
+        sent = []
+
+        def receiver(sender, instance, **kwargs):
+            # children go first
+            self.assertFalse(
+                NodeTree.objects.filter(parent_id=instance.pk).exists())
+            sent.append(instance.name)
+        signals.post_delete.connect(receiver, sender=NodeTree)
+        try:
+            self.n2.delete_subtree(send_signals=True)
+        finally:
+            signals.post_delete.disconnect(receiver, sender=NodeTree)
+        self.assertEqual(sorted(sent), ['2', '3', '4'])
+        self.assertEqual(
+            list(NodeTreeLink.objects.values_list('node__name', flat=True)),
+            ['5'])
+        self.assertEqual(
+            sorted(NodeTree._tpm.objects.values_list(
+                'descendant__name', flat=True)),
+            ['1', '5', '5', '6'])
+
+    def test_rebuild_without_tree_id(self):
+        self.assertRaises(ValueError, Node._rebuild_tree, tree_id=1)
+
+
+class CTTSortKeyTest(TestCase):
+    def setUp(self):
+        """
+            1         6
+           / \
+          2   5
+         / \
+        3   4
+        """
+        self.n1 = NodeSorted.objects.create(name='1')
+        self.n2 = NodeSorted.objects.create(name='2', parent=self.n1)
+        self.n3 = NodeSorted.objects.create(name='3', parent=self.n2)
+        self.n4 = NodeSorted.objects.create(name='4', parent=self.n2)
+        self.n5 = NodeSorted.objects.create(name='5', parent=self.n1)
+        self.n6 = NodeSorted.objects.create(name='6')
+
+    def assertPreorder(self, node, expected):
+        node = NodeSorted.objects.get(pk=node.pk)
+        self.assertEqual(
+            [n.name for n in node.get_descendants(include_self=True,
+                                                  ordered=True)],
+            expected)
+
+        def walk(node):
+            names = [node.name]
+            for child in node.get_children():
+                names.extend(walk(child))
+            return names
+        self.assertEqual(walk(node), expected)
+
+    def test_preorder(self):
+        self.assertPreorder(self.n1, ['1', '2', '3', '4', '5'])
+        self.assertEqual(
+            list(NodeSorted.objects.order_by('sort_key').
+                 values_list('name', flat=True)),
+            ['1', '2', '3', '4', '5', '6'])
+
+    def test_descendants_by_parent_preorder(self):
+        with self.assertNumQueries(1):
+            grouped = NodeSorted.objects.descendants_by_parent(
+                [self.n1, self.n6], min_depth=0)
+        self.assertEqual([n.name for n in grouped[self.n1.pk]],
+                         ['1', '2', '3', '4', '5'])
+        self.assertEqual([n.name for n in grouped[self.n6.pk]], ['6'])
+
+    def test_slicing(self):
+        descendants = self.n1.get_descendants(ordered=True)
+        self.assertEqual([n.name for n in descendants[1:3]], ['3', '4'])
+        self.assertEqual([n.name for n in descendants.iterator()],
+                         ['2', '3', '4', '5'])
+
+    def test_reorder(self):
+        self.n5.move_before(self.n2)
+        self.assertPreorder(self.n1, ['1', '5', '2', '3', '4'])
+        self.n3.move_after(self.n4)
+        self.assertPreorder(self.n1, ['1', '5', '2', '4', '3'])
+
+    def test_reorder_with_stale_instance(self):
+        n3 = NodeSorted.objects.get(pk=self.n3.pk)
+        self.n2.move_to(self.n5)
+        # n3 still holds the key of its old place
+        n3.move_after(NodeSorted.objects.get(pk=self.n4.pk))
+        self.assertPreorder(self.n1, ['1', '5', '2', '4', '3'])
+
+    def _rebalance_queries(self, size):
+        parent = NodeSorted.objects.create(name='p%d' % size)
+        for i in xrange(size):
+            # respacing gives every sibling a new order and key prefix
+            child = NodeSorted.objects.create(name='c%d' % i, parent=parent,
+                                              order=i * 3 + 1)
+            NodeSorted.objects.create(name='g%d' % i, parent=child)
+        with CaptureQueriesContext(connection) as queries:
+            NodeSorted(name='new', parent=parent)._rebalance_siblings()
+        expected = [parent.name]
+        for i in xrange(size):
+            expected.extend(['c%d' % i, 'g%d' % i])
+        self.assertPreorder(parent, expected)
+        return len(queries)
+
+    def test_rebalance_queries_constant(self):
+        self.assertEqual(self._rebalance_queries(3),
+                         self._rebalance_queries(150))
+
+    def test_reorder_rebalance(self):
+        NodeSorted.objects.create(name='7', parent=self.n5)
+        NodeSorted.objects.create(name='8', parent=self.n1)
+        subtrees = {'2': ['2', '3', '4'], '5': ['5', '7'], '8': ['8']}
+        names = ['2', '5', '8']
+        # gaps after 2 halve until siblings are respaced
+        for i in xrange(6):
+            node = NodeSorted.objects.get(name=names[-1])
+            node.move_after(NodeSorted.objects.get(name='2'))
+            names.insert(1, names.pop())
+            expected = ['1']
+            for name in names:
+                expected.extend(subtrees[name])
+            self.assertPreorder(self.n1, expected)
+
+    def test_move(self):
+        self.n2.move_to(self.n6)
+        self.assertPreorder(self.n1, ['1', '5'])
+        self.assertPreorder(self.n6, ['6', '2', '3', '4'])
+        self.n2.move_to(None)
+        self.assertPreorder(self.n2, ['2', '3', '4'])
+        self.assertEqual(NodeSorted.objects.get(name='4').sort_key[:16],
+                         NodeSorted.objects.get(name='2').sort_key)
+
+    def test_bulk_create_tree(self):
+        n7 = NodeSorted(name='7', parent=self.n2)
+        n8 = NodeSorted(name='8', parent=n7)
+        n9 = NodeSorted(name='9')
+        NodeSorted.objects.bulk_create_tree([n9, n8, n7])
+        self.assertPreorder(self.n1, ['1', '2', '3', '4', '7', '8', '5'])
+        self.assertEqual(n7.sort_key,
+                         NodeSorted.objects.get(pk=n7.pk).sort_key)
+        self.assertEqual(NodeSorted.objects.order_by('-sort_key')[0].name,
+                         '9')
+
+    def test_insert_under_deferred_parent(self):
+        with NodeSorted.tree_updates_deferred():
+            b = NodeSorted.objects.create(name='b', parent=self.n6)
+        # sort_key of b was set when deferring ended, not on the instance
+        NodeSorted.objects.create(name='c', parent=b)
+        self.assertPreorder(self.n6, ['6', 'b', 'c'])
+        self.assertEqual(NodeSorted._check_tree()['sort_key'], [])
+
+    def test_check_sort_key(self):
+        self.assertEqual(NodeSorted._check_tree()['sort_key'], [])
+        NodeSorted.objects.filter(pk=self.n2.pk).update(
+            sort_key=self.n6.sort_key + self.n2.sort_key[-16:])
+        # keys of 3 and 4 still extend the old key of 2
+        self.assertEqual(sorted(NodeSorted._check_tree()['sort_key']),
+                         sorted([self.n2.pk, self.n3.pk, self.n4.pk]))
+        self.assertEqual(NodeSorted._repair_tree(), 3)
+        self.assertEqual(NodeSorted._check_tree()['sort_key'], [])
+        self.assertPreorder(self.n1, ['1', '2', '3', '4', '5'])
+
+    def test_sort_key_length(self):
+        self.assertEqual(
+            NodeSortedShallow._meta.get_field('sort_key').max_length, 48)
+        n1 = NodeSortedShallow.objects.create(name='1')
+        n2 = NodeSortedShallow.objects.create(name='2', parent=n1)
+        n3 = NodeSortedShallow.objects.create(name='3', parent=n2)
+        self.assertRaises(ValueError, NodeSortedShallow.objects.create,
+                          name='4', parent=n3)
+        self.assertEqual(NodeSortedShallow.objects.count(), 3)
+        r = NodeSortedShallow.objects.create(name='r')
+        NodeSortedShallow.objects.create(name='c', parent=r)
+        # c would end up at the fourth level
+        self.assertRaises(ValueError, r.move_to, n2)
+        self.assertEqual(
+            NodeSortedShallow.objects.get(pk=r.pk).parent_id, None)
+        r.move_to(n1)
+        self.assertEqual(
+            [(n.name, n.level) for n in r.get_descendants(include_self=True,
+                                                          ordered=True)],
+            [('r', 1), ('c', 2)])
+        self.assertEqual(NodeSortedShallow._check_tree()['sort_key'], [])
+
+    def test_rebuild_tree(self):
+        NodeSorted.objects.update(sort_key='')
+        NodeSorted._rebuild_tree()
+        self.assertPreorder(self.n1, ['1', '2', '3', '4', '5'])
+
+    def test_get_tree(self):
+        self.n4.move_before(self.n3)
+        root = NodeSorted.objects.get(pk=self.n1.pk).get_tree()
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                [n.name for n in root.get_descendants(ordered=True)],
+                ['2', '4', '3', '5'])
+
+    def test_unordered_model(self):
+        self.assertRaises(ValueError, Node().get_descendants, ordered=True)
+
+
+class CTTRegisterTest(TestCase):
+    def test_tree_manager_installed(self):
+        root = NodePlainManager.objects.create(name='1')
+        NodePlainManager.objects.create(name='2', parent=root)
+        self.assertFalse(hasattr(NodePlainManager.objects, 'roots'))
+        self.assertEqual(list(NodePlainManager.tree.roots()), [root])
+        self.assertFalse(hasattr(Node, 'tree'))
+
+    def test_path_indexes(self):
+        opts = NodeCompact._tpm._meta
+        self.assertEqual(opts.unique_together, [('descendant', 'ancestor')])
+        self.assertEqual(opts.index_together,
+                         [('ancestor', 'path_len', 'descendant')])
+        self.assertFalse(opts.get_field('ancestor').db_index)
+        self.assertFalse(opts.get_field('path_len').db_index)
+        self.assertIsInstance(opts.get_field('path_len'),
+                              models.PositiveSmallIntegerField)
+        self.assertTrue(Node._tpm._meta.get_field('path_len').db_index)
+        self.assertEqual(Node._tpm._meta.unique_together,
+                         (('ancestor', 'descendant'),))
+
+    def test_path_indexes_tree(self):
+        n1 = NodeCompact.objects.create(name='1')
+        n2 = NodeCompact.objects.create(name='2', parent=n1)
+        n3 = NodeCompact.objects.create(name='3', parent=n2)
+        n4 = NodeCompact.objects.create(name='4')
+        n2.move_to(n4)
+        self.assertEqual(list(n4.get_descendants(max_depth=1)), [n2])
+        self.assertEqual(list(n3.get_ancestors()), [n4, n2])
+        self.assertEqual(NodeCompact._check_tree(),
+                         {'missing': [], 'extra': [], 'path_len': [],
+                          'level': []})
+
+    def test_register_rejects_unknown_path_indexes(self):
+        class NodeBadIndexes(CTTModel):
+            class Meta:
+                abstract = True
+
+        self.assertRaises(ImproperlyConfigured, ctt.register,
+                          NodeBadIndexes, path_indexes='everything')
+
+    def test_stats(self):
+        NodeCompact.objects.create(name='1')
+        out = StringIO()
+        call_command('ctt_stats', 'testapp.NodeCompact', stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], 'testapp.NodeCompact')
+        self.assertTrue(lines[1].startswith('  testapp_nodecompact: 1 rows, '))
+        self.assertTrue(lines[5].startswith(
+            '  testapp_nodecompacttreepath: 1 rows, '))
+        indexes = [line for line in lines if line.startswith('    index ')]
+        # parent, level, (parent, level) on nodes, unique and covering on
+        # paths
+        self.assertEqual(len(indexes), 5)
+        self.assertTrue(lines[-1].startswith('  total: '))
+
+    def test_stats_without_dbstat(self):
+        cursor = connection.cursor
+
+        class NoDbstatCursor(object):
+            def __init__(self, cursor):
+                self.cursor = cursor
+
+            def __getattr__(self, attr):
+                return getattr(self.cursor, attr)
+
+            def execute(self, sql, params=None):
+                if 'dbstat' in sql:
+                    raise OperationalError('no such table: dbstat')
+                return self.cursor.execute(sql, params)
+
+        connection.cursor = lambda: NoDbstatCursor(cursor())
+        try:
+            self.assertRaises(CommandError, call_command, 'ctt_stats',
+                              'testapp.NodeCompact', stdout=StringIO())
+        finally:
+            del connection.cursor
+        self.assertRaises(CommandError, call_command, 'ctt_stats',
+                          'testapp.NodeTreeLink', stdout=StringIO())
+
+
+class CTTAdjacencyListTest(TestCase):
+    def setUp(self):
+        """
+            1
+           / \
+          2   5
+         / \
+        3   4
+        """
+        self.n1 = NodeAdjacency.objects.create(name='1')
+        self.n2 = NodeAdjacency.objects.create(name='2', parent=self.n1)
+        self.n3 = NodeAdjacency.objects.create(name='3', parent=self.n2)
+        self.n4 = NodeAdjacency.objects.create(name='4', parent=self.n2)
+        self.n5 = NodeAdjacency.objects.create(name='5', parent=self.n1)
+        self.n6 = NodeAdjacency.objects.create(name='6')
+
+    def names(self, nodes):
+        return sorted(node.name for node in nodes)
+
+    def test_no_closure_table(self):
+        self.assertIsNone(NodeAdjacency._tpm)
+        self.assertIsNone(NodeAdjacency.tpd)
+
+    def test_register_rejects_closure_options(self):
+        class NodeAdjacencyCounted(CTTModel):
+            class Meta:
+                abstract = True
+
+            class CTTMeta:
+                cache_counts = True
+
+        self.assertRaises(ImproperlyConfigured, ctt.register,
+                          NodeAdjacencyCounted, AdjacencyListStrategy)
+
+    def test_reads(self):
+        self.assertEqual(self.names(self.n1.get_descendants()),
+                         ['2', '3', '4', '5'])
+        self.assertEqual(
+            self.names(self.n2.get_descendants(include_self=True)),
+            ['2', '3', '4'])
+        self.assertEqual(self.names(self.n1.get_children()), ['2', '5'])
+        self.assertEqual([n.name for n in self.n3.get_ancestors()],
+                         ['1', '2'])
+        self.assertEqual(
+            [n.name for n in self.n3.get_ancestors(include_self=True,
+                                                   ascending=True)],
+            ['3', '2', '1'])
+        root = NodeAdjacency.objects.get(pk=self.n1.pk).get_tree(max_depth=1)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.names(root.get_children()), ['2', '5'])
+        self.assertEqual(self.names(self.n1.get_leafnodes()), ['3', '4', '5'])
+        self.assertEqual(self.names(self.n3.get_siblings()), ['4'])
+        self.assertEqual(self.n4.get_root(), self.n1)
+        self.assertTrue(self.n1.is_ancestor_of(self.n4))
+        self.assertFalse(self.n5.is_ancestor_of(self.n4))
+        self.assertTrue(self.n4.is_descendant_of(self.n2))
+        self.assertEqual(self.n1.get_descendant_count(), 4)
+        self.assertTrue(self.n3.is_leaf_node())
+        self.assertFalse(self.n2.is_leaf_node())
+
+    def test_queryset(self):
+        objects = NodeAdjacency.objects
+        self.assertEqual(
+            self.names(objects.descendants_of([self.n2, self.n5])),
+            ['3', '4'])
+        self.assertEqual(
+            self.names(objects.ancestors_of(
+                objects.filter(name__in=['3', '5']))), ['1', '2'])
+        self.assertEqual(self.names(objects.leaves()), ['3', '4', '5', '6'])
+        nodes = dict((n.name, n) for n in objects.with_descendant_count().
+                     with_child_count().with_is_leaf())
+        self.assertEqual(nodes['1'].descendant_count, 4)
+        self.assertEqual(nodes['1'].child_count, 2)
+        self.assertEqual(nodes['2'].is_leaf, 0)
+        self.assertEqual(nodes['6'].is_leaf, 1)
+
+    def test_prefetch_ancestors(self):
+        with self.assertNumQueries(2):
+            nodes = dict((n.name, n) for n in
+                         NodeAdjacency.objects.with_ancestors())
+        with self.assertNumQueries(0):
+            self.assertEqual([n.name for n in nodes['4'].get_ancestors()],
+                             ['1', '2'])
+            self.assertEqual(list(nodes['1'].get_ancestors()), [])
+
+    def test_move(self):
+        self.n2.move_to(self.n6)
+        self.assertEqual(
+            dict(NodeAdjacency.objects.values_list('name', 'level')),
+            {'1': 0, '2': 1, '3': 2, '4': 2, '5': 1, '6': 0})
+        self.assertEqual(self.names(self.n6.get_descendants()),
+                         ['2', '3', '4'])
+        n6 = NodeAdjacency.objects.get(pk=self.n6.pk)
+        n6.parent = self.n5
+        n6.save()
+        self.assertEqual(NodeAdjacency.objects.get(pk=self.n3.pk).level, 4)
+        self.assertEqual([n.name for n in self.n3.get_ancestors()],
+                         ['1', '5', '6', '2'])
+
+    def test_descendants_depth(self):
+        self.assertEqual(self.names(self.n1.get_descendants(max_depth=1)),
+                         ['2', '5'])
+        self.assertEqual(self.names(self.n1.get_descendants(min_depth=2)),
+                         ['3', '4'])
+        with self.assertNumQueries(1):
+            grouped = NodeAdjacency.objects.exclude(name='5'). \
+                descendants_by_parent([self.n1, self.n2, self.n6])
+        self.assertEqual(
+            dict((pk, [n.name for n in nodes])
+                 for pk, nodes in grouped.items()),
+            {self.n1.pk: ['2', '3', '4'], self.n2.pk: ['3', '4'],
+             self.n6.pk: []})
+        grouped = NodeAdjacency.objects.descendants_by_parent(
+            [self.n1], min_depth=0, max_depth=1)
+        self.assertEqual([n.name for n in grouped[self.n1.pk]],
+                         ['1', '2', '5'])
+
+    def test_delete_subtree(self):
+        self.n2.delete_subtree()
+        self.assertEqual(self.names(NodeAdjacency.objects.all()),
+                         ['1', '5', '6'])
+
+    def test_rebuild_and_bulk_create(self):
+        NodeAdjacency.objects.update(level=7)
+        NodeAdjacency._rebuild_tree()
+        self.assertEqual(NodeAdjacency.objects.get(pk=self.n4.pk).level, 2)
+        n7 = NodeAdjacency(name='7', parent=self.n4)
+        n8 = NodeAdjacency(name='8', parent=n7)
+        NodeAdjacency.objects.bulk_create_tree([n7, n8])
+        self.assertEqual(n8.level, 4)
+        self.assertEqual(self.names(self.n2.get_descendants()),
+                         ['3', '4', '7', '8'])
+
+
 class CTTDummyOrderableTest(TestCase):
     def setUp(self):
         """
@@ -527,12 +1695,44 @@ class CTTDummyOrderableTest(TestCase):
         self.assertTrue(self.n5 in descendants)
         self.assertFalse(self.n1 in descendants)
 
+    def test_get_tree_order(self):
+        n7 = NodeOrderable.objects.create(name='7', parent=self.n2,
+            order=self.n3.order - 1)
+        root = self.n1.get_tree()
+        with self.assertNumQueries(0):
+            n2 = list(root.get_children())[0]
+            self.assertEqual(list(n2.get_children()), [n7, self.n3, self.n4])
+
+    def test_descendants_by_parent_order(self):
+        NodeOrderable.objects.create(name='7', parent=self.n2,
+                                     order=self.n3.order - 1)
+        with self.assertNumQueries(1):
+            grouped = NodeOrderable.objects.descendants_by_parent([self.n1])
+        self.assertEqual([n.name for n in grouped[self.n1.pk]],
+                         ['2', '5', '7', '3', '4'])
+
     def test_original_order(self):
         self.assertEqual(self.n3.get_next_sibling(), self.n4)
         self.assertEqual(self.n4.get_previous_sibling(), self.n3)
         self.assertNotEqual(self.n4.get_next_sibling(), self.n3)
         self.assertNotEqual(self.n3.get_previous_sibling(), self.n4)
 
+    def test_get_siblings_batch(self):
+        n7 = NodeOrderable.objects.create(name='7', parent=self.n2)
+        # same order as n3, ties are broken by pk
+        NodeOrderable.objects.filter(pk=n7.pk).update(order=self.n3.order)
+        n7 = NodeOrderable.objects.get(pk=n7.pk)
+        next_links = NodeOrderable.get_next_siblings([self.n3, self.n4, n7])
+        self.assertEqual(next_links, {self.n3.pk: n7, n7.pk: self.n4,
+                                      self.n4.pk: None})
+        previous_links = NodeOrderable.get_previous_siblings(
+            [self.n3, n7, self.n1])
+        self.assertEqual(previous_links,
+                         {self.n3.pk: None, n7.pk: self.n3, self.n1.pk: None})
+        self.assertEqual(self.n3.get_next_sibling(), n7)
+        self.assertEqual(n7.get_next_sibling(), self.n4)
+        self.assertEqual(self.n4.get_previous_sibling(), n7)
+
     def test_original_order_added(self):
         n7 = NodeOrderable.objects.create(name='7', parent=self.n2)
         self.assertEqual(n7.get_next_sibling(), None)
@@ -581,9 +1781,34 @@ class CTTDummyOrderableTest(TestCase):
         self.n2.move_after(self.n5)
         n2 = NodeOrderable.objects.get(name='2')
         n5 = NodeOrderable.objects.get(name='5')
-        self.assertEqual(n2.order, 11)
+        self.assertEqual(n2.order, 20)
         self.assertEqual(n5.order, 10)
 
+    def test_move_into_gap(self):
+        n7 = NodeOrderable.objects.create(name='7', parent=self.n2)
+        self.assertEqual(n7.order, 20)
+        # neighbour lookup, conflict check and update
+        with self.assertNumQueries(3):
+            n7.move_after(self.n3)
+        self.assertEqual(n7.order, 5)
+        self.assertEqual(
+            [n.name for n in self.n2.get_children()], ['3', '7', '4'])
+        n7.move_before(self.n3)
+        self.assertEqual(n7.order, -10)
+
+    def test_move_rebalance(self):
+        NodeOrderable.objects.create(name='7', parent=self.n2)
+        names = ['3', '7', '4']
+        # gaps between 3 and the moved node halve until rebalance
+        for i in xrange(6):
+            last = NodeOrderable.objects.get(name=names[-1])
+            last.move_after(NodeOrderable.objects.get(name='3'))
+            names.insert(1, names.pop())
+            self.assertEqual(
+                [n.name for n in self.n2.get_children()], names)
+        orders = sorted(self.n2.get_children().values_list('order',
+                                                           flat=True))
+        self.assertEqual(len(set(orders)), 3)
 
 
 class CTTConflictsOrderableTest(TestCase):
@@ -607,9 +1832,25 @@ class CTTConflictsOrderableTest(TestCase):
         lowest.order += 1
         lowest.save()
 
-        self.assertEqual(lowest.order, 3)
-        for item in NodeOrderable.objects.filter(parent=self.root):
-            self.assertEqual(item.order, int(item.name) + 1)
+        # placed right before the sibling it collided with, nothing shifts
+        self.assertEqual(lowest.order, -7)
+        for item in NodeOrderable.objects.filter(parent=self.root). \
+                exclude(pk=lowest.pk):
+            self.assertEqual(item.order, int(item.name))
+
+    def test_conflict_in_the_middle(self):
+        node = NodeOrderable.objects.get(name='10')
+        node.order = 20
+        # no gap between 19 and 20: two lookups, respacing (one select and
+        # an update per 300 siblings) and the save itself
+        with self.assertNumQueries(8):
+            node.save()
+        orders = list(NodeOrderable.objects.filter(parent=self.root).
+                      values_list('name', 'order'))
+        names = [name for name, order in orders]
+        self.assertEqual(names.index('10') + 1, names.index('20'))
+        self.assertEqual(len(set(order for name, order in orders)),
+                         len(orders))
 
 class RebuildTreeMixin(object):
 
@@ -661,6 +1902,404 @@ class CTTDummyRebuildQSTest(RebuildTreeMixin, CTTDummyTest):
         self.assertEqual(tpms_before, Node._tpm.objects.count())
 
 
+class CTTRebuildQSScopeTest(TestCase):
+    def setUp(self):
+        """
+            1
+           / \
+          2   5
+         / \
+        3   4
+        """
+        self.n1 = NodeTree.objects.create(name='1')
+        self.n2 = NodeTree.objects.create(name='2', parent=self.n1)
+        self.n3 = NodeTree.objects.create(name='3', parent=self.n2)
+        self.n4 = NodeTree.objects.create(name='4', parent=self.n2)
+        self.n5 = NodeTree.objects.create(name='5', parent=self.n1)
+
+    def assertConsistent(self):
+        self.assertEqual([name for name, rows in
+                          NodeTree._check_tree().items() if rows], [])
+
+    def test_leaf(self):
+        NodeTree._tpm.objects.filter(descendant=self.n3).delete()
+        self.assertEqual(
+            NodeTree._rebuild_qs(NodeTree.objects.filter(pk=self.n3.pk)), 1)
+        self.assertConsistent()
+
+    def test_consistent_tree(self):
+        self.assertEqual(NodeTree._rebuild_qs(NodeTree.objects.filter(
+            pk__in=[self.n3.pk, self.n5.pk])), 2)
+        self.assertConsistent()
+
+    def test_broken_ancestor(self):
+        NodeTree._tpm.objects.filter(descendant=self.n2,
+                                     ancestor=self.n1).delete()
+        # the subtree of 2 is repaired with the leaf
+        self.assertEqual(
+            NodeTree._rebuild_qs(NodeTree.objects.filter(pk=self.n3.pk)), 3)
+        self.assertConsistent()
+
+    def test_stale_ancestor_columns(self):
+        NodeTree.objects.filter(pk=self.n2.pk).update(level=5)
+        self.assertEqual(
+            NodeTree._rebuild_qs(NodeTree.objects.filter(pk=self.n4.pk)), 3)
+        NodeTree.objects.filter(pk=self.n2.pk).update(tree_id=self.n5.pk)
+        NodeTree._tpm.objects.filter(descendant=self.n1).update(tree_id=None)
+        self.assertEqual(
+            NodeTree._rebuild_qs(NodeTree.objects.filter(pk=self.n4.pk)), 5)
+        self.assertConsistent()
+
+    def test_cycle(self):
+        NodeTree.objects.filter(pk=self.n1.pk).update(parent=self.n3)
+        self.assertRaises(ValueError, NodeTree._rebuild_qs,
+                          NodeTree.objects.filter(pk=self.n4.pk))
+
+    def test_rebuild_tree_cycle(self):
+        NodeTree.objects.filter(pk=self.n2.pk).update(parent=self.n3)
+        paths = NodeTree._tpm.objects.count()
+        self.assertRaises(ValueError, NodeTree._rebuild_tree)
+        # rolled back
+        self.assertEqual(NodeTree._tpm.objects.count(), paths)
+        self.assertFalse(NodeTree.objects.filter(level=-1).exists())
+        self.assertRaises(CommandError, call_command, 'ctt_rebuild',
+                          'testapp.NodeTree', stdout=StringIO())
+
+
+class CTTCheckTreeTest(TestCase):
+    def create(self, model):
+        """
+            1
+           / \
+          2   5
+         / \
+        3   4
+        """
+        nodes = {}
+        for name, parent in (('1', None), ('2', '1'), ('3', '2'), ('4', '2'),
+                             ('5', '1'), ('6', None)):
+            nodes[name] = model.objects.create(name=name,
+                                               parent=nodes.get(parent))
+        return nodes
+
+    def paths(self, model):
+        return sorted(model._tpm.objects.values_list(
+            'ancestor__name', 'descendant__name', 'path_len'))
+
+    def corrupt(self, model, n):
+        tp = model._tpm.objects
+        tp.filter(ancestor=n['1'], descendant=n['3']).delete()
+        tp.create(ancestor=n['6'], descendant=n['4'], path_len=2)
+        tp.filter(ancestor=n['2'], descendant=n['4']).update(path_len=5)
+        model.objects.filter(pk=n['5'].pk).update(level=3)
+
+    def test_consistent(self):
+        self.create(Node)
+        with self.assertNumQueries(4):
+            report = Node._check_tree()
+        self.assertEqual(report, {'missing': [], 'extra': [], 'path_len': [],
+                                  'level': []})
+        self.assertEqual(Node._repair_tree(report), 0)
+
+    def test_check_and_repair(self):
+        n = self.create(Node)
+        paths = self.paths(Node)
+        self.corrupt(Node, n)
+        report = Node._check_tree()
+        self.assertEqual(report, {
+            'missing': [(n['1'].pk, n['3'].pk)],
+            'extra': [(n['6'].pk, n['4'].pk)],
+            'path_len': [(n['2'].pk, n['4'].pk)],
+            'level': [n['5'].pk],
+        })
+        # subtrees of 3, 4 and 5
+        self.assertEqual(Node._repair_tree(report), 3)
+        self.assertEqual(self.paths(Node), paths)
+        self.assertEqual(Node.objects.get(pk=n['5'].pk).level, 1)
+        self.assertEqual(sum(map(len, Node._check_tree().values())), 0)
+
+    def test_repair_subtree(self):
+        n = self.create(Node)
+        paths = self.paths(Node)
+        Node._tpm.objects.filter(descendant__in=[n['2'], n['4']]).delete()
+        Node.objects.filter(pk=n['3'].pk).update(level=0)
+        self.assertEqual(Node._repair_tree(), 3)
+        self.assertEqual(self.paths(Node), paths)
+        self.assertEqual(
+            dict(Node.objects.values_list('name', 'level')),
+            {'1': 0, '2': 1, '3': 2, '4': 2, '5': 1, '6': 0})
+
+    def test_repair_counts_and_tree_id(self):
+        n = self.create(NodeCounted)
+        self.corrupt(NodeCounted, n)
+        NodeCounted.objects.filter(pk=n['2'].pk).update(descendant_count=0)
+        NodeCounted._repair_tree()
+        self.assertEqual(list(NodeCounted._check_counts()), [])
+        self.assertEqual(sum(map(len, NodeCounted._check_tree().values())),
+                         0)
+
+        n = self.create(NodeTree)
+        NodeTree.objects.filter(pk=n['2'].pk).update(tree_id=n['6'].pk)
+        # children of 2 disagree with it too
+        self.assertEqual(sorted(NodeTree._check_tree()['tree_id']),
+                         sorted([n['2'].pk, n['3'].pk, n['4'].pk]))
+        self.assertEqual(NodeTree._repair_tree(), 3)
+        self.assertEqual(set(NodeTree.objects.filter(
+            pk__in=[n['2'].pk, n['3'].pk]).values_list('tree_id', flat=True)),
+            set([n['1'].pk]))
+        self.assertEqual(set(NodeTree._tpm.objects.filter(
+            descendant=n['4']).values_list('tree_id', flat=True)),
+            set([n['1'].pk]))
+
+    def test_repair_sort_key(self):
+        n = self.create(NodeSorted)
+        sort_keys = dict(NodeSorted.objects.values_list('name', 'sort_key'))
+        self.corrupt(NodeSorted, n)
+        NodeSorted._repair_tree()
+        self.assertEqual(
+            dict(NodeSorted.objects.values_list('name', 'sort_key')),
+            sort_keys)
+
+    def test_adjacency_list(self):
+        n = self.create(NodeAdjacency)
+        NodeAdjacency.objects.filter(pk=n['2'].pk).update(level=5)
+        # 2 and its children
+        self.assertEqual(sorted(NodeAdjacency._check_tree()['level']),
+                         sorted([n['2'].pk, n['3'].pk, n['4'].pk]))
+        self.assertEqual(NodeAdjacency._repair_tree(), 3)
+        self.assertEqual(NodeAdjacency._check_tree(), {'level': []})
+
+    def test_command(self):
+        n = self.create(Node)
+        out = StringIO()
+        call_command('ctt_rebuild', 'testapp.Node', check=True, stdout=out)
+        self.assertEqual(out.getvalue(), 'Checking testapp.Node: ok\n')
+        self.corrupt(Node, n)
+        out = StringIO()
+        call_command('ctt_rebuild', 'testapp.Node', repair=True, stdout=out)
+        self.assertEqual(
+            out.getvalue(),
+            'Checking testapp.Node: 1 extra, 1 level, 1 missing, 1 path_len\n'
+            '  3 nodes rewritten\n')
+        self.assertEqual(sum(map(len, Node._check_tree().values())), 0)
+
+
+class CTTDeferredUpdatesTest(TestCase):
+    def paths(self):
+        return sorted(Node._tpm.objects.values_list(
+            'ancestor__name', 'descendant__name', 'path_len'))
+
+    def test_create_and_move(self):
+        """
+            1
+           / \\
+          2   5
+         / \\
+        3   4
+        """
+        with Node.tree_updates_deferred():
+            n1 = Node.objects.create(name='1')
+            n6 = Node.objects.create(name='6')
+            n2 = Node.objects.create(name='2', parent=n6)
+            n3 = Node.objects.create(name='3', parent=n2)
+            n4 = Node.objects.create(name='4', parent=n2)
+            n5 = Node.objects.create(name='5', parent=n1)
+            n2.move_to(n1)
+            self.assertEqual(Node._tpm.objects.count(), 0)
+        self.assertEqual(sum(map(len, Node._check_tree().values())), 0)
+        self.assertEqual(
+            dict(Node.objects.values_list('name', 'level')),
+            {'1': 0, '2': 1, '3': 2, '4': 2, '5': 1, '6': 0})
+        paths = self.paths()
+        Node._rebuild_tree()
+        self.assertEqual(self.paths(), paths)
+        # stale tree columns of instances are refreshed on next save
+        n4.save()
+        self.assertEqual(Node.objects.get(pk=n4.pk).level, 2)
+        self.assertEqual([n.name for n in n3.get_ancestors()], ['1', '2'])
+        self.assertEqual(n5.get_root(), n1)
+        self.assertEqual(n6.get_descendant_count(), 0)
+
+    def test_nested_and_exception(self):
+        n1 = Node.objects.create(name='1')
+        with Node.tree_updates_deferred():
+            with Node.tree_updates_deferred():
+                Node.objects.create(name='2', parent=n1)
+            # applied by the outer block only
+            self.assertEqual(Node._tpm.objects.count(), 1)
+        self.assertEqual(Node._tpm.objects.count(), 3)
+        try:
+            with Node.tree_updates_deferred():
+                Node.objects.create(name='3', parent=n1)
+                raise KeyError
+        except KeyError:
+            pass
+        self.assertEqual(Node.objects.count(), 2)
+        self.assertEqual(Node._tpm.objects.count(), 3)
+
+    def test_cycle(self):
+        n1 = Node.objects.create(name='1')
+        n2 = Node.objects.create(name='2', parent=n1)
+        with self.assertRaises(ValueError):
+            with Node.tree_updates_deferred():
+                n1.move_to(n2)
+        self.assertIsNone(Node.objects.get(pk=n1.pk).parent_id)
+        self.assertEqual(Node._tpm.objects.count(), 3)
+
+    def test_counts(self):
+        n1 = NodeCounted.objects.create(name='1')
+        n2 = NodeCounted.objects.create(name='2', parent=n1)
+        n3 = NodeCounted.objects.create(name='3')
+        with NodeCounted.tree_updates_deferred():
+            NodeCounted.objects.create(name='4', parent=n2)
+            n2.move_to(n3)
+        self.assertEqual(list(NodeCounted._check_counts()), [])
+        self.assertEqual(
+            NodeCounted.objects.get(pk=n1.pk).descendant_count, 0)
+        self.assertEqual(
+            NodeCounted.objects.get(pk=n3.pk).descendant_count, 2)
+
+    @override_settings(CTT_DEFER_LOADDATA=True)
+    def test_loaddata(self):
+        call_command('loaddata', 'ctt_nodes', verbosity=0)
+        self.assertEqual(sum(map(len, Node._check_tree().values())), 0)
+        self.assertEqual(
+            dict(Node.objects.values_list('name', 'level')),
+            {'1': 0, '2': 1, '3': 2, '4': 1})
+        self.assertEqual(Node._tpm.objects.count(), 8)
+
+
+class CTTRebuildLevelTest(TestCase):
+    def setUp(self):
+        self.n1 = Node.objects.create(name='1')
+        self.n2 = Node.objects.create(name='2', parent=self.n1)
+        self.n3 = Node.objects.create(name='3', parent=self.n2)
+        self.n4 = Node.objects.create(name='4')
+
+    def test_rebuild_levels(self):
+        Node.objects.update(level=7)
+        Node._tpm.objects.all().delete()
+        Node._rebuild_tree()
+        levels = dict(Node.objects.values_list('name', 'level'))
+        self.assertEqual(levels, {'1': 0, '2': 1, '3': 2, '4': 0})
+        self.assertEqual(Node._tpm.objects.count(), 7)
+        self.assertEqual(
+            list(self.n3.get_ancestors(ascending=True)), [self.n2, self.n1])
+
+    def test_rebuild_progress(self):
+        calls = []
+        Node._rebuild_tree(progress=lambda level, count: calls.append(
+            (level, count)))
+        self.assertEqual(calls, [(0, 2), (1, 1), (2, 1)])
+
+    def test_rebuild_command(self):
+        Node._tpm.objects.all().delete()
+        out = StringIO()
+        call_command('ctt_rebuild', 'testapp.Node', verbosity=2, stdout=out)
+        self.assertTrue('level 2: 1 nodes' in out.getvalue())
+        self.assertEqual(Node._tpm.objects.count(), 7)
+
+
+class CTTInstrumentationTest(TestCase):
+    def setUp(self):
+        """
+            1
+           / \
+          2   5
+         / \
+        3   4
+        """
+        self.n1 = Node.objects.create(name='1')
+        self.n2 = Node.objects.create(name='2', parent=self.n1)
+        self.n3 = Node.objects.create(name='3', parent=self.n2)
+        self.n4 = Node.objects.create(name='4', parent=self.n2)
+        self.n5 = Node.objects.create(name='5', parent=self.n1)
+        self.n6 = Node.objects.create(name='6')
+        self.events = []
+        tree_operation.connect(self.receiver, sender=Node)
+
+    def tearDown(self):
+        tree_operation.disconnect(self.receiver, sender=Node)
+
+    def receiver(self, sender, **kwargs):
+        kwargs.pop('signal')
+        self.events.append(kwargs)
+
+    def test_move(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.n2.move_to(self.n6)
+        # nested save() is reported as part of move_to()
+        self.assertEqual(len(self.events), 1)
+        event = self.events[0]
+        self.assertEqual(event['operation'], 'move_to')
+        self.assertEqual(event['node'], self.n2)
+        self.assertEqual(event['pk'], self.n2.pk)
+        self.assertEqual(event['subtree_size'], 3)
+        # paths from 1 replaced by paths from 6
+        self.assertEqual(event['paths_deleted'], 3)
+        self.assertEqual(event['paths_inserted'], 3)
+        # subtree_size is counted after the operation
+        self.assertEqual(event['queries'], len(queries) - 1)
+        self.assertTrue(event['rows_written'] >= 6)
+        self.assertTrue(event['elapsed'] >= 0)
+
+    def test_insert_and_rebuild(self):
+        Node.objects.create(name='7', parent=self.n3)
+        Node._rebuild_tree()
+        save, rebuild = self.events
+        self.assertEqual(save['operation'], 'save')
+        self.assertEqual(save['subtree_size'], 1)
+        self.assertEqual(save['paths_inserted'], 4)
+        self.assertEqual(rebuild['operation'], 'rebuild_tree')
+        self.assertIsNone(rebuild['node'])
+        self.assertEqual(rebuild['subtree_size'], 7)
+        self.assertEqual(rebuild['paths_deleted'], 16)
+        self.assertEqual(rebuild['paths_inserted'], 16)
+
+    def test_other_models_not_measured(self):
+        NodeOrderable.objects.create(name='1')
+        self.assertEqual(self.events, [])
+
+    @override_settings(CTT_SLOW_OPERATION_SECONDS=0)
+    def test_log_slow_operation(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger('ctt')
+        logger.addHandler(handler)
+        tree_operation.connect(log_slow_operation, sender=Node)
+        try:
+            self.n5.delete_subtree()
+        finally:
+            tree_operation.disconnect(log_slow_operation, sender=Node)
+            logger.removeHandler(handler)
+        self.assertEqual(len(records), 1)
+        self.assertTrue('Node.delete_subtrees on node None' in
+                        records[0].getMessage())
+
+
+class CTTBenchmarkTest(TestCase):
+    def test_benchmark_command(self):
+        out = StringIO()
+        call_command('ctt_benchmark', models='Node,NodeOrderable',
+                     sizes='40', samples=5, in_place=True, label='test',
+                     stdout=out)
+        results = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(len(results), 2 * 4 * 11 - 4)
+        # one query per call, the closure table is not joined for children
+        for children in [r for r in results
+                         if r['operation'] == 'get_children']:
+            self.assertEqual(children['queries'], children['count'])
+        insert = [r for r in results if r['model'] == 'Node' and
+                  r['shape'] == 'kary' and r['operation'] == 'insert'][0]
+        self.assertEqual(insert['count'], 40)
+        # nodes, then a path to self and to each ancestor: levels are
+        # 0, 1 (x4), 2 (x16) and 3 (x19)
+        self.assertEqual(insert['rows_written'], 40 + 40 + 4 + 32 + 57)
+        self.assertEqual(Node.objects.count(), 0)
+        self.assertEqual(Node._tpm.objects.count(), 0)
+
+
 class CTTDummyOrderableRebuildTest(RebuildTreeMixin, CTTDummyOrderableTest):
     def setUp(self):
         super(CTTDummyOrderableRebuildTest, self).setUp()